@@ -17,17 +17,35 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import urllib, re, os, time
-from sgmllib import SGMLParser
+import urllib, re, os, time, threading
 from http import ExtendedHTTPConnection
+from backend import get_backend
 
-class Article(SGMLParser):
+# Why Article.set failed (Article.error)
+SESSION_EXPIRED = "session"
+EDIT_CONFLICT = "conflict"
+PERMISSION_DENIED = "permission"
+SERVER_ERROR = "server"
+SAVE_FAILED = "failed"
+
+# Shown by Mediawiki when an edit is rejected because the session expired
+SESSION_FAILURE = re.compile("session[_-]?fail|loss of session data",
+                             re.IGNORECASE)
+# Edit conflict form, with the text of the user in a second textarea
+CONFLICT_FAILURE = re.compile("name=[\"']?wpTextbox2", re.IGNORECASE)
+# Protected page, blocked user, spam filters...
+PERMISSION_FAILURE = re.compile("permissions?-?errors|protectedpagetext|"
+                                "blockedtext|spamprotection|abusefilter|"
+                                "titleblacklist|captcha", re.IGNORECASE)
+# The database is locked for maintenance
+READONLY_FAILURE = re.compile("readonlytext", re.IGNORECASE)
+
+class WikiClient:
     """
-    Gets and sets an article.
+    Sends requests to a Mediawiki site.
     """
-    
+
     def __init__(self,
-                 name,
                  host,
                  basename,
                  cookie_str=None,
@@ -35,37 +53,116 @@ class Article(SGMLParser):
                  port=None,
                  httpauth_username=None,
                  httpauth_password=None,
-                 cache_time = 30,
-                 # logger is passed as an argument so that Article remains
-                 # an independant class
+                 # logger is passed as an argument so that WikiClient
+                 # remains an independant class
                  logger = None,
+                 # api.php path, guessed from basename if not given
+                 api=None,
+                 # "api", "edit" or "auto" (see backend.py)
+                 fetch_backend=None,
+                 # session.Session shared by the clients of a site, whose
+                 # cookies replace cookie_str
+                 session=None,
                  # Not actually needed, just here for compatibility
                  dirname=None,
                  domain=None,
                  username=None,
                  password=None,
+                 memory_cache_size=None,
+                 recent_changes=None,
+                 read_ahead=None,
+                 read_ahead_threads=None,
+                 read_ahead_depth=None,
+                 kernel_cache=None,
                  ):
-        SGMLParser.__init__(self)
 
-        # Mediawiki replaces spaces with underscores
-        # because an URL cannot contain spaces        
-        self.name = name.replace(" ", "_")
         self.host = host
         self.basename = basename
         self.cookie_str = cookie_str
+        self.session = session
         self.https = https
         self.port = port
         self.httpauth_username = httpauth_username
         self.httpauth_password = httpauth_password
-        self.cache_time = cache_time
         self.logger = logger
+
+        if api is None:
+            api = os.path.join(os.path.dirname(self.basename), "api.php")
+        self.api_page = api
+
+        self.backend = get_backend(fetch_backend,
+                                   (self.host, self.port, self.api_page))
+
+    def get_cookie_str(self, login=True):
+        """
+        Returns the cookie string sent with the requests. The session logs
+        in first if needed, unless login is False.
+        """
+        if self.session is not None and login:
+            return self.session.get()
+        elif self.session is not None:
+            return self.session.peek()
+        return self.cookie_str
+
+    def request(self, path, data=None, headers={}):
+        """
+        Sends a request to the site and returns the connection and the
+        response. The connection must be closed once the response is read.
+        """
+        conn = ExtendedHTTPConnection(self.host, self.port, self.https)
+
+        if self.httpauth_username and self.httpauth_password:
+            conn.http_auth(self.httpauth_username, self.httpauth_password)
+
+        conn.add_header("User-agent", "WikipediaFS")
+        cookie_str = self.get_cookie_str()
+        if cookie_str is not None:
+            conn.add_header("Cookie", cookie_str)
+        conn.add_headers(headers)
+
+        if data is not None:
+            conn.add_data(data)
+        conn.request(path)
+        response = conn.getresponse()
+
+        # Log http response
+        if self.logger:
+            if data is None:
+                self.logger.info("HTTP GET %s" % path)
+            else:
+                self.logger.info("HTTP POST %s" % path)
+
+        return (conn, response)
+
+class Article(WikiClient):
+    """
+    Gets and sets an article.
+    """
+    
+    def __init__(self, name, host, basename, cache_time = 30, **kwargs):
+        WikiClient.__init__(self, host, basename, **kwargs)
+
+        # Mediawiki replaces spaces with underscores
+        # because an URL cannot contain spaces        
+        self.name = name.replace(" ", "_")
+        self.cache_time = cache_time
                  
+        # Held while the article is got or set, so that it is
+        # downloaded or uploaded only once at a time
+        self.lock = threading.RLock()
+
         self.content = ""
-        self.textarea = False
+        self.is_empty = True
         self.wpEdittime = 0
         self.wpStarttime = 0
         self.wpEditToken = None
+        # Cookie string of the session wpEditToken belongs to (False until
+        # a token is got)
+        self.token_cookie_str = False
+        self.revid = None
         self.last_get = 0
+        # Why the last set failed (SESSION_EXPIRED, EDIT_CONFLICT...)
+        self.error = None
 
         # url patterns
         title = urllib.urlencode({"title" : self.name})
@@ -77,74 +174,44 @@ class Article(SGMLParser):
         self.submit_page = "%s?%s&action=submit" % \
                             (self.basename, title)                          
 
-    def start_textarea(self,attrs):
-        """
-        Called when a textarea is entered.
-        """
-        self.textarea = True
-        self.content = ""
-    
-    def start_input(self,attrs):
-        """
-        Called when an input is entered.
+    def expired(self):
         """
-        # To set an article, we need to now its wpEdittime first.
-        
-        if len(attrs) == 3 and attrs[2][1] == "wpEdittime":
-            self.wpEdittime = attrs[1][1]
-        elif len(attrs) == 3 and attrs[2][1] == "wpEditToken":
-            self.wpEditToken = attrs[1][1]            
-        elif len(attrs) == 3 and attrs[2][1] == "wpStarttime":
-            self.wpStarttime = attrs[1][1]            
-            
-    def end_textarea(self):
+        Returns True if the next get will download the article.
         """
-        Called when a textarea is left.
+        return int(time.time()) - self.last_get > self.cache_time
+
+    def load(self, content, revid, edittime):
         """
-        self.textarea = False
-        
-    def handle_data(self,data):
+        Sets the article from a copy known to be current instead of
+        downloading it.
         """
-        Called when data is parsed.
-        """            
-        # We add the parsed data to self.content when the data parsed
-        # is in a textarea
-        if self.textarea == True:
-            self.content += data
+        self.content = content
+        self.revid = revid
+        self.wpEdittime = edittime
+        self.wpStarttime = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+        self.last_get = int(time.time())
 
     def get(self): 
         """
         Gets the wiki content (not the whole html page).
         """
+        self.lock.acquire()
+        try:
+            return self.__get()
+        finally:
+            self.lock.release()
 
+    def __get(self):
         # Do not get article if cache is still ok
-        if int(time.time()) - self.last_get > self.cache_time:       
-            self.logger.debug("pre-GET wpStarttime: '%s', wpEdittime: '%s', cookies: '%s', time diff: %d\n", self.wpEdittime, self.wpStarttime, self.cookie_str, int(time.time()) - self.last_get)
-            headers = {"User-agent" : "WikipediaFS"}
-            
-            if self.cookie_str is not None:
-                headers["Cookie"] = self.cookie_str
-                
-            conn = ExtendedHTTPConnection(self.host, self.port, self.https)
-
-            if self.httpauth_username and self.httpauth_password:
-                conn.http_auth(self.httpauth_username, self.httpauth_password)
-
-            conn.add_headers(headers)
-            conn.request(self.edit_page)
-            #logger.info("HTTP GET %s" % self.edit_page)
-            response = conn.getresponse()
-                   
-            # Log http response
+        if self.expired():
             if self.logger:
-                self.logger.info("HTTP GET %s" % self.edit_page)        
-            
-            # Feeds the SGMLparser
-            self.feed(response.read())
-            conn.close()
+                self.logger.debug("pre-GET wpStarttime: '%s', wpEdittime: '%s', cookies: '%s', time diff: %d\n", self.wpEdittime, self.wpStarttime, self.get_cookie_str(False), int(time.time()) - self.last_get)
+
+            self.backend.fetch(self)
 
             self.last_get = int(time.time())
-            self.logger.debug("post-GET wpStarttime: '%s', wpEdittime: '%s', cookies: '%s', time diff: %d\n", self.wpEdittime, self.wpStarttime, self.cookie_str, int(time.time()) - self.last_get)
+            if self.logger:
+                self.logger.debug("post-GET wpStarttime: '%s', wpEdittime: '%s', cookies: '%s', time diff: %d\n", self.wpEdittime, self.wpStarttime, self.get_cookie_str(False), int(time.time()) - self.last_get)
         else:
             if self.logger:
                 self.logger.debug("Get %s from cache" % self.name)
@@ -159,10 +226,20 @@ class Article(SGMLParser):
               
         
     def set(self, text):
+        self.lock.acquire()
+        try:
+            return self.__set(text)
+        finally:
+            self.lock.release()
+
+    def __set(self, text):
+        self.error = None
         if text == self.content: 
             return True # useless to continue further...
 
-        self.logger.debug("POST wpStarttime: '%s', wpEdittime: '%s', cookies: '%s', time diff: %d\n", self.wpEdittime, self.wpStarttime, self.cookie_str, int(time.time()) - self.last_get)
+        cookie_str = self.get_cookie_str()
+        if self.logger:
+            self.logger.debug("POST wpStarttime: '%s', wpEdittime: '%s', cookies: '%s', time diff: %d\n", self.wpEdittime, self.wpStarttime, cookie_str, int(time.time()) - self.last_get)
         
         # Looking for a [[Summary:*]]
         regexp = '((\[\[)((s|S)ummary:)(.*)(\]\])(( )*\n)?)'
@@ -183,61 +260,78 @@ class Article(SGMLParser):
         }
         
         # Needed for logged in edition
-        if self.wpEditToken is not None:
-            params["wpEditToken"] = self.wpEditToken
+        wpEditToken = self.backend.edit_token(self)
+        if wpEditToken is not None:
+            params["wpEditToken"] = wpEditToken
                 
         params = urllib.urlencode(params)
         
-        headers = {"Content-type": "application/x-www-form-urlencoded",
-                   "User-agent" : "WikipediaFS"}
+        headers = {"Content-type": "application/x-www-form-urlencoded"}
         
-        if self.cookie_str is not None:
-            headers["Cookie"] = self.cookie_str
-        
-        conn = ExtendedHTTPConnection(self.host, self.port, self.https)
+        conn, response = self.request(self.submit_page, params, headers)
 
-        if self.httpauth_username and self.httpauth_password:
-            conn.http_auth(self.httpauth_username, self.httpauth_password)
-
-        conn.add_headers(headers)
-        conn.add_data(params)
-        conn.request(self.submit_page)
-        
-        response = conn.getresponse()
+        body = ""
+        if response.status != 302:
+            body = response.read()
         
         # Log http response
         if self.logger:
-            self.logger.info("HTTP POST %s" % self.submit_page)
             if response.status == 302:
                 self.logger.info("Succesful")
             elif response.status == 200:
-                self.logger.error("Problems occured %s\n" % response.read())
+                self.logger.error("Problems occured %s\n" % body)
                 self.logger.debug("Headers: '%s'\n" % headers)
                 self.logger.debug("Text: '%s'\n" % text)
             else:
-                self.logger.info("%d \n %s " % \
-                                    (response.status,response.read()))
+                self.logger.info("%d \n %s " % (response.status, body))
 
         conn.close()
 
-        self.content = text
-        
         # forces the article to be get next time
         # (wpEdittime and wpStarttime need to be updated)
         self.last_get = 0
 
+        # Did the write actually succeed?
+        if response.status != 302:
+            self.error = self.failure(response.status, body)
+            if self.error == SESSION_EXPIRED and self.session is not None:
+                self.session.expired(cookie_str)
+            if self.logger:
+                self.logger.debug("article.set: Returning false (%s).\n" %
+                                  self.error)
+            return False
+
+        self.content = text
+
         # This allows to quickly now from the fs is the article is empty
         if len(self.content.strip()) == 0:
             self.is_empty = True
         else:
             self.is_empty = False            
 
-        # Did the write actually succeed?
-        if response.status == 302:
-            return True
+        return True
+
+    def failure(self, status, body):
+        """
+        Tells why a save failed from the response of the server.
+        """
+        if status >= 500:
+            return SERVER_ERROR
+        elif status == 403:
+            return PERMISSION_DENIED
+        elif status != 200:
+            return SAVE_FAILED
+        # The edit page is shown again, with the reason
+        elif SESSION_FAILURE.search(body):
+            return SESSION_EXPIRED
+        elif CONFLICT_FAILURE.search(body):
+            return EDIT_CONFLICT
+        elif PERMISSION_FAILURE.search(body):
+            return PERMISSION_DENIED
+        elif READONLY_FAILURE.search(body):
+            return SERVER_ERROR
         else:
-            self.logger.debug("article.set: Returning false.\n")
-            return False
+            return SAVE_FAILED
 
 
 if __name__ == "__main__":
@@ -0,0 +1,719 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import urllib, re, time, calendar, threading, json
+from sgmllib import SGMLParser
+from htmlentitydefs import name2codepoint
+
+# Canonical name and number of the namespace of the categories, the
+# canonical name is understood by every site
+CATEGORY = "Category:"
+CATEGORY_NAMESPACE = 14
+
+class ApiUnavailable(Exception):
+    """
+    Raised when api.php cannot be used on a site.
+    """
+
+class ApiError(Exception):
+    """
+    Raised when a request to api.php fails although the API is there
+    (server errors, errors of the request itself).
+    """
+
+class EditPageParser(SGMLParser):
+    """
+    Extracts the wiki content and the hidden form fields from an edit page.
+    Superseded by EditPageExtractor, only kept to compare the two.
+    """
+
+    def __init__(self):
+        SGMLParser.__init__(self)
+        self.content = ""
+        self.textarea = False
+        self.wpEdittime = 0
+        self.wpStarttime = 0
+        self.wpEditToken = None
+
+    def start_textarea(self,attrs):
+        """
+        Called when a textarea is entered.
+        """
+        self.textarea = True
+        self.content = ""
+    
+    def start_input(self,attrs):
+        """
+        Called when an input is entered.
+        """
+        # To set an article, we need to now its wpEdittime first.
+        
+        if len(attrs) == 3 and attrs[2][1] == "wpEdittime":
+            self.wpEdittime = attrs[1][1]
+        elif len(attrs) == 3 and attrs[2][1] == "wpEditToken":
+            self.wpEditToken = attrs[1][1]            
+        elif len(attrs) == 3 and attrs[2][1] == "wpStarttime":
+            self.wpStarttime = attrs[1][1]            
+            
+    def end_textarea(self):
+        """
+        Called when a textarea is left.
+        """
+        self.textarea = False
+        
+    def handle_data(self,data):
+        """
+        Called when data is parsed.
+        """            
+        # We add the parsed data to self.content when the data parsed
+        # is in a textarea
+        if self.textarea == True:
+            self.content += data
+
+class EditPageExtractor:
+    """
+    Extracts the wiki content and the hidden form fields from an edit page
+    fed chunk by chunk.
+    Only the textarea and input tags are looked for, the content is kept
+    as a list of fragments joined once, and done becomes True as soon as
+    everything needed has been seen so that the rest of the page does not
+    have to be parsed.
+    """
+
+    FIELDS = ("wpEdittime", "wpStarttime", "wpEditToken")
+
+    TAG = re.compile(r"<(textarea|input|/form)\b([^>]*)>", re.IGNORECASE)
+    ATTR = re.compile(r"""([\w-]+)\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""")
+    END_TEXTAREA = re.compile(r"</textarea\s*>", re.IGNORECASE)
+    TEXTAREA = re.compile(r"</textarea\s*>|<(textarea|input)\b",
+                          re.IGNORECASE)
+    # Longest string which may be the beginning of a cut </textarea>
+    END_TEXTAREA_MAX = len("</textarea>") + 8
+
+    def __init__(self):
+        self.parts = []
+        self.fields = {}
+        self.tail = ""
+        self.in_textarea = False
+        self.have_textbox = False
+        self.done = False
+
+    def feed(self, data):
+        if self.done:
+            return
+
+        buf = self.tail + data
+        pos = 0
+        while not self.done:
+            if self.in_textarea:
+                if self.have_textbox:
+                    match = self.END_TEXTAREA.search(buf, pos)
+                else:
+                    # Not a real textarea (e.g. in a script) if a tag we
+                    # look for starts before it ends
+                    match = self.TEXTAREA.search(buf, pos)
+                if match is None:
+                    cut = max(pos, len(buf) - self.END_TEXTAREA_MAX)
+                    self.parts.append(buf[pos:cut])
+                    pos = cut
+                    break
+                if match.group(0)[1] != "/":
+                    self.in_textarea = False
+                    pos = match.start()
+                    continue
+                self.parts.append(buf[pos:match.start()])
+                self.in_textarea = False
+                pos = match.end()
+                self.check_done()
+                continue
+
+            match = self.TAG.search(buf, pos)
+            if match is None:
+                # Keep the beginning of a tag which may have been cut
+                lt = buf.rfind("<", pos)
+                if lt != -1 and buf.find(">", lt) == -1:
+                    pos = lt
+                else:
+                    pos = len(buf)
+                break
+
+            pos = match.end()
+            tag = match.group(1).lower()
+            attrs = self.parse_attrs(match.group(2))
+            if tag == "textarea":
+                if not self.have_textbox:
+                    # As before, the last textarea wins unless it is
+                    # wpTextbox1
+                    self.parts = []
+                    self.in_textarea = True
+                    self.have_textbox = attrs.get("name") == "wpTextbox1"
+            elif tag == "input":
+                if attrs.get("name") in self.FIELDS:
+                    self.fields[attrs["name"]] = attrs.get("value", "")
+                    self.check_done()
+            elif self.have_textbox:
+                # </form>
+                self.done = True
+
+        self.tail = buf[pos:]
+
+    def check_done(self):
+        if self.have_textbox and not self.in_textarea and \
+           len(self.fields) == len(self.FIELDS):
+            self.done = True
+
+    def parse_attrs(self, text):
+        attrs = {}
+        for name, value in self.ATTR.findall(text):
+            if value[0] in "\"'":
+                value = value[1:-1]
+            attrs[name.lower()] = unescape(value)
+        return attrs
+
+    def close(self):
+        if self.in_textarea:
+            # Truncated page
+            self.parts.append(self.tail)
+        self.tail = ""
+
+    def get_content(self):
+        return unescape("".join(self.parts))
+
+class EditPageBackend:
+    """
+    Scrapes the whole action=edit HTML page.
+    Works with any Mediawiki site, even when api.php is disabled.
+    """
+
+    name = "edit"
+
+    def fetch(self, article):
+        cookie_str = article.get_cookie_str()
+        extractor = self.get_edit_page(article)
+        article.content = extractor.get_content()
+        article.wpEdittime = extractor.fields.get("wpEdittime", 0)
+        article.wpStarttime = extractor.fields.get("wpStarttime", 0)
+        article.wpEditToken = extractor.fields.get("wpEditToken")
+        article.token_cookie_str = cookie_str
+        article.revid = None
+
+    def get_edit_page(self, article):
+        conn, response = article.request(article.edit_page)
+
+        # Feeds the extractor as the page is downloaded, the end of the
+        # page is only read to keep the connection alive
+        extractor = EditPageExtractor()
+        for data in response.chunks():
+            extractor.feed(data)
+            if extractor.done:
+                break
+        extractor.close()
+        conn.close()
+        return extractor
+
+    def edit_token(self, article):
+        # The token comes with the edit page. It is only valid in the
+        # session it was got in: after the session logged in again, a new
+        # one is taken from the edit page (the rest of the page is not
+        # used, so that edit conflicts are still found).
+        cookie_str = article.get_cookie_str()
+        if article.token_cookie_str != cookie_str:
+            article.wpEditToken = None
+            extractor = self.get_edit_page(article)
+            article.wpEditToken = extractor.fields.get("wpEditToken")
+            article.token_cookie_str = cookie_str
+        return article.wpEditToken
+
+    def stat(self, client, titles):
+        # Attributes can only be known by getting the articles
+        return None
+
+    def list_pages(self, client, prefix, cont=None):
+        # Articles can not be listed
+        return None
+
+    def list_members(self, client, category, cont=None, limit=None):
+        return None
+
+    def recent_changes(self, client, start, cont=None):
+        # Changes can not be followed
+        return None
+
+class ApiBackend:
+    """
+    Gets only the wikitext, the revision id and the timestamp through
+    api.php. The edit token is fetched separately, when an article is
+    saved, and cached for the session.
+    """
+
+    name = "api"
+
+    # Titles per list_pages request (the maximum for most users)
+    LIST_LIMIT = 500
+
+    # Requests failing with a server error (5xx) are tried again
+    # QUERY_RETRIES times, after QUERY_RETRY_DELAY seconds, then twice as
+    # long each time
+    QUERY_RETRIES = 2
+    QUERY_RETRY_DELAY = 1
+
+    # Error codes meaning that the API is disabled
+    DISABLED_ERRORS = ("unknown_action", "apidisabled")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # edit tokens by cookie string
+        self.tokens = {}
+
+    def query(self, article, params):
+        """
+        Sends a query to api.php and returns its decoded result. Raises
+        ApiUnavailable if there is no API (404, not JSON, API disabled)
+        and ApiError if the API fails otherwise.
+        """
+        params = params.copy()
+        params["format"] = "json"
+        delay = self.QUERY_RETRY_DELAY
+        for i in range(self.QUERY_RETRIES + 1):
+            conn, response = article.request("%s?%s" % (article.api_page,
+                                             urllib.urlencode(params)))
+            body = response.read()
+            conn.close()
+            if response.status < 500 or i == self.QUERY_RETRIES:
+                break
+            time.sleep(delay)
+            delay *= 2
+
+        if response.status == 404:
+            raise ApiUnavailable("HTTP status %d" % response.status)
+        elif response.status != 200:
+            raise ApiError("HTTP status %d" % response.status)
+        try:
+            result = json.loads(body)
+        except ValueError:
+            raise ApiUnavailable("Not a JSON response")
+        if result.has_key("error"):
+            error = result["error"]
+            info = error.get("info", "API error")
+            if self.DISABLED_ERRORS.count(error.get("code")) == 1:
+                raise ApiUnavailable(info)
+            raise ApiError(info)
+        return result
+
+    def fetch(self, article):
+        result = self.query(article, {
+            "action" : "query",
+            "prop" : "revisions",
+            "rvprop" : "content|ids|timestamp",
+            "rvslots" : "main",
+            "titles" : article.name
+        })
+
+        try:
+            page = result["query"]["pages"].values()[0]
+        except (KeyError, IndexError):
+            raise ApiUnavailable("Unexpected API response")
+
+        if page.has_key("missing") or not page.has_key("revisions"):
+            # New article: wpEdittime must be empty
+            content = ""
+            edittime = ""
+            revid = None
+        else:
+            rev = page["revisions"][0]
+            if rev.has_key("slots"):
+                content = rev["slots"]["main"].get("*", "")
+            else:
+                content = rev.get("*", "")
+            edittime = api_to_edittime(rev["timestamp"])
+            revid = rev["revid"]
+
+        article.content = content.encode("utf-8")
+        article.wpEdittime = edittime
+        article.wpStarttime = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+        article.revid = revid
+
+    def edit_token(self, article):
+        cookie_str = article.get_cookie_str()
+        self.lock.acquire()
+        try:
+            if self.tokens.has_key(cookie_str):
+                return self.tokens[cookie_str]
+        finally:
+            self.lock.release()
+
+        result = self.query(article, {
+            "action" : "query",
+            "meta" : "tokens"
+        })
+
+        if result.get("query", {}).has_key("tokens"):
+            token = result["query"]["tokens"]["csrftoken"]
+        else:
+            # Mediawiki < 1.24
+            result = self.query(article, {
+                "action" : "query",
+                "prop" : "info",
+                "intoken" : "edit",
+                "titles" : article.name
+            })
+            token = result["query"]["pages"].values()[0]["edittoken"]
+
+        token = token.encode("utf-8")
+        self.lock.acquire()
+        try:
+            self.tokens[cookie_str] = token
+        finally:
+            self.lock.release()
+        return token
+
+    def stat(self, client, titles):
+        """
+        Returns the attributes of several articles without their content,
+        as a dictionary title -> attributes (see new_attrs).
+        """
+        result = self.query(client, {
+            "action" : "query",
+            "prop" : "info|revisions",
+            "rvprop" : "size|timestamp|ids",
+            "titles" : "|".join(titles)
+        })
+
+        # The API answers with normalized titles
+        names = {}
+        for title in titles:
+            names[title.replace("_", " ")] = title
+        for norm in result.get("query", {}).get("normalized", []):
+            origin = norm["from"].encode("utf-8")
+            names[norm["to"].encode("utf-8")] = names.get(origin, origin)
+
+        attrs = {}
+        for page in result.get("query", {}).get("pages", {}).values():
+            title = page["title"].encode("utf-8")
+            title = names.get(title, title.replace(" ", "_"))
+            attrs[title] = self.page_attrs(page)
+        return attrs
+
+    def page_attrs(self, page):
+        if page.has_key("missing") or page.has_key("invalid") or \
+           not page.has_key("revisions"):
+            return new_attrs(False)
+        rev = page["revisions"][0]
+        return new_attrs(True, rev.get("size", page.get("length")),
+                         api_to_mtime(rev["timestamp"]), rev["revid"])
+
+    def list_pages(self, client, prefix, cont=None):
+        """
+        Returns one batch of the articles of the main namespace whose
+        titles start with prefix, with their attributes, as a tuple
+        (title -> attributes, continuation). The next batch is got by
+        passing the continuation back, until it is None.
+        """
+        params = {
+            "generator" : "allpages",
+            "gapnamespace" : "0",
+            "gaplimit" : str(self.LIST_LIMIT)
+        }
+        if prefix:
+            params["gapprefix"] = prefix.replace("_", " ")
+        return self.generate(client, params, "allpages", cont)
+
+    def list_members(self, client, category, cont=None, limit=None):
+        """
+        Same as list_pages for the members of a category, given as
+        "Category:Name". The titles of the subcategories always start
+        with "Category:", whatever the language of the site.
+        At most limit members are got per request (LIST_LIMIT by default).
+        """
+        params = {
+            "generator" : "categorymembers",
+            "gcmtitle" : category.replace("_", " "),
+            "gcmlimit" : str(limit or self.LIST_LIMIT)
+        }
+        return self.generate(client, params, "categorymembers", cont)
+
+    def generate(self, client, params, generator, cont=None):
+        # One batch of the pages of a generator with their attributes
+        params = params.copy()
+        params.update({
+            "action" : "query",
+            "prop" : "info|revisions",
+            "rvprop" : "size|timestamp|ids"
+        })
+        if cont is not None:
+            params.update(cont)
+        result = self.query(client, params)
+
+        attrs = {}
+        for page in result.get("query", {}).get("pages", {}).values():
+            attrs[self.title(page)] = self.page_attrs(page)
+
+        return attrs, self.continuation(result, generator)
+
+    def recent_changes(self, client, start, cont=None):
+        """
+        Returns one batch of the changes made on the site since start (an
+        API timestamp), oldest first, as a tuple (changes, continuation).
+        Each change is a dictionary with the title, type ("edit", "new",
+        "log" or "categorize"), rcid, timestamp, revid and size of the
+        changed article, and the target title of a move.
+        Titles of categories start with "Category:" as in list_members.
+        """
+        params = {
+            "action" : "query",
+            "list" : "recentchanges",
+            "rcdir" : "newer",
+            "rcstart" : start,
+            "rcprop" : "title|ids|sizes|timestamp|loginfo",
+            "rclimit" : str(self.LIST_LIMIT)
+        }
+        if cont is not None:
+            params.update(cont)
+        result = self.query(client, params)
+
+        changes = []
+        for rc in result.get("query", {}).get("recentchanges", []):
+            target = rc.get("logparams", {}).get("target_title")
+            if target is not None:
+                target = target.encode("utf-8").replace(" ", "_")
+            changes.append({
+                "title" : self.title(rc),
+                "type" : rc["type"].encode("utf-8"),
+                "rcid" : rc["rcid"],
+                "timestamp" : rc["timestamp"].encode("utf-8"),
+                "revid" : rc.get("revid") or None,
+                "size" : rc.get("newlen", 0),
+                "target" : target
+            })
+        return changes, self.continuation(result, "recentchanges")
+
+    def title(self, page):
+        # Title of a page (or change) of the API, with underscores
+        title = page["title"].encode("utf-8").replace(" ", "_")
+        if page.get("ns") == CATEGORY_NAMESPACE:
+            # Localized namespace name
+            title = CATEGORY + title.split(":", 1)[-1]
+        return title
+
+    def continuation(self, result, module):
+        # Parameters to get the next batch of a list, or None
+        if result.has_key("continue"):
+            cont = result["continue"]
+        elif result.get("query-continue", {}).has_key(module):
+            # Mediawiki < 1.21
+            cont = result["query-continue"][module]
+        else:
+            return None
+        return dict([(k.encode("utf-8"), unicode(v).encode("utf-8"))
+                     for k, v in cont.items()])
+
+class AutoBackend:
+    """
+    Uses api.php and falls back for good on the edit page as soon as the
+    API turns out to be unavailable. Other errors of the API (ApiError)
+    are raised and do not disable it.
+    """
+
+    name = "auto"
+
+    def __init__(self):
+        self.api = ApiBackend()
+        self.edit = EditPageBackend()
+        self.api_enabled = True
+
+    def fetch(self, article):
+        if self.api_enabled:
+            try:
+                return self.api.fetch(article)
+            except ApiUnavailable, detail:
+                self.disable_api(article, detail)
+        return self.edit.fetch(article)
+
+    def edit_token(self, article):
+        if self.api_enabled:
+            try:
+                return self.api.edit_token(article)
+            except ApiUnavailable, detail:
+                self.disable_api(article, detail)
+        return self.edit.edit_token(article)
+
+    def stat(self, client, titles):
+        if self.api_enabled:
+            try:
+                return self.api.stat(client, titles)
+            except ApiUnavailable, detail:
+                self.disable_api(client, detail)
+        return None
+
+    def list_pages(self, client, prefix, cont=None):
+        if self.api_enabled:
+            try:
+                return self.api.list_pages(client, prefix, cont)
+            except ApiUnavailable, detail:
+                self.disable_api(client, detail)
+        return None
+
+    def list_members(self, client, category, cont=None, limit=None):
+        if self.api_enabled:
+            try:
+                return self.api.list_members(client, category, cont, limit)
+            except ApiUnavailable, detail:
+                self.disable_api(client, detail)
+        return None
+
+    def recent_changes(self, client, start, cont=None):
+        if self.api_enabled:
+            try:
+                return self.api.recent_changes(client, start, cont)
+            except ApiUnavailable, detail:
+                self.disable_api(client, detail)
+        return None
+
+    def disable_api(self, article, detail):
+        if article.logger:
+            article.logger.warning("api.php unavailable on %s (%s), "
+                                   "using edit pages" % (article.host, detail))
+        self.api_enabled = False
+
+BACKENDS = {
+    "edit" : EditPageBackend,
+    "api" : ApiBackend,
+    "auto" : AutoBackend
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(name, site):
+    """
+    Returns the backend shared by all the articles of a site.
+    site is any hashable value identifying the site.
+    """
+    if name is None:
+        name = "auto"
+
+    _backends_lock.acquire()
+    try:
+        key = (name, site)
+        if not _backends.has_key(key):
+            _backends[key] = BACKENDS[name]()
+        return _backends[key]
+    finally:
+        _backends_lock.release()
+
+ENTITY = re.compile("&(#[xX]?)?(\w+);")
+
+def _convert_entity(match):
+    try:
+        if match.group(1) is None:
+            codepoint = name2codepoint[match.group(2)]
+        elif match.group(1) == "#":
+            codepoint = int(match.group(2))
+        else:
+            codepoint = int(match.group(2), 16)
+        return unichr(codepoint).encode("utf-8")
+    except (KeyError, ValueError, OverflowError):
+        return match.group(0)
+
+def unescape(text):
+    """
+    Replaces HTML entities and character references with UTF-8 characters.
+    """
+    if text.find("&") == -1:
+        return text
+
+    # Fast path for what htmlspecialchars() produces
+    for entity, char in (("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'),
+                         ("&#039;", "'")):
+        text = text.replace(entity, char)
+    if text.count("&") == text.count("&amp;"):
+        return text.replace("&amp;", "&")
+
+    return ENTITY.sub(_convert_entity, text)
+
+def new_attrs(exists, size=0, mtime=0, revid=None):
+    return {
+        "exists" : exists,
+        "size" : size,
+        "mtime" : mtime,
+        "revid" : revid
+    }
+
+def edittime_to_mtime(edittime):
+    """
+    20070512201503 (UTC) -> seconds since the epoch
+    """
+    edittime = str(edittime)
+    if len(edittime) < 14:
+        return 0
+    return calendar.timegm((int(edittime[0:4]), int(edittime[4:6]),
+                            int(edittime[6:8]), int(edittime[8:10]),
+                            int(edittime[10:12]), int(edittime[12:14]),
+                            0, 0, 0))
+
+def api_to_mtime(timestamp):
+    return edittime_to_mtime(api_to_edittime(timestamp))
+
+def api_to_edittime(timestamp):
+    """
+    2007-05-12T20:15:03Z -> 20070512201503
+    """
+    return timestamp.replace("-", "").replace(":", "").replace("T", "") \
+                    .replace("Z", "").encode("utf-8")
+
+if __name__ == "__main__":
+    # Benchmark of the edit page parsers on a big article
+    import timeit
+
+    lines = []
+    for i in range(10000):
+        lines.append("Line %d with &lt;b&gt;markup&lt;/b&gt; &amp; " \
+                     "&quot;entities&quot;" % i)
+    page = "<html><body>" + "<div class='skin'>skin</div>" * 2000 + \
+           '<form><input type="hidden" value="20070101000000" ' \
+           'name="wpStarttime" /><input type="hidden" ' \
+           'value="20070512201503" name="wpEdittime" />' \
+           '<textarea name="wpTextbox1">' + "\n".join(lines) + \
+           '</textarea><input type="hidden" value="abc+\\" ' \
+           'name="wpEditToken" /></form>' + \
+           "<div class='footer'>footer</div>" * 2000 + "</body></html>"
+    chunks = [page[i:i + 16384] for i in range(0, len(page), 16384)]
+
+    def parse_sgml():
+        parser = EditPageParser()
+        for data in chunks:
+            parser.feed(data)
+        return parser.content
+
+    def parse_extractor():
+        extractor = EditPageExtractor()
+        for data in chunks:
+            extractor.feed(data)
+            if extractor.done:
+                break
+        extractor.close()
+        return extractor.get_content()
+
+    assert parse_sgml() == parse_extractor()
+
+    print "page size: %d bytes" % len(page)
+    for name, func in (("EditPageParser", parse_sgml),
+                       ("EditPageExtractor", parse_extractor)):
+        t = min(timeit.repeat(func, number=1, repeat=3))
+        print "%-18s %8.2f ms" % (name, t * 1000)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import mmap, tempfile
+from cStringIO import StringIO
+from hashlib import sha1
+
+class SpillBuffer:
+    """
+    Content of an opened file, kept in memory up to threshold bytes and
+    in a temporary file mapped in memory above, so that big files do not
+    take their size in RAM. The temporary file has no name: it goes away
+    with the buffer, or with the process.
+    Reads and writes are given their offset and only copy the bytes they
+    read or write. There is no current position, so a buffer can be
+    shared by several handles (with a lock).
+    """
+
+    # Bytes hashed at a time
+    CHUNK_SIZE = 65536
+
+    def __init__(self, threshold=1024 * 1024):
+        self.threshold = threshold
+        self.length = 0
+        # In memory until it is spilled
+        self.data = StringIO()
+        self.file = None
+        self.map = None
+
+    def size(self):
+        return self.length
+
+    def read(self, size, offset):
+        end = min(self.length, offset + size)
+        if offset >= end:
+            return ""
+        if self.map is not None:
+            return self.map[offset:end]
+        self.data.seek(offset)
+        return self.data.read(end - offset)
+
+    def write(self, txt, offset):
+        if offset > self.length:
+            # Hole filled with zeros, as in a file
+            self.write("\0" * (offset - self.length), self.length)
+
+        end = offset + len(txt)
+        self.__reserve(end)
+        if self.map is not None:
+            self.map[offset:end] = txt
+        else:
+            self.data.seek(offset)
+            self.data.write(txt)
+        self.length = max(self.length, end)
+        return len(txt)
+
+    def truncate(self, size):
+        if size > self.length:
+            self.write("\0" * (size - self.length), self.length)
+        elif size < self.length:
+            if self.map is None:
+                self.data.truncate(size)
+            # Otherwise the end of the map is overwritten when it grows
+            self.length = size
+
+    def getvalue(self):
+        if self.map is not None:
+            return self.map[0:self.length]
+        return self.data.getvalue()
+
+    def hash(self):
+        """
+        Returns the SHA-1 of the content, without copying all of it.
+        """
+        if self.map is None:
+            return sha1(self.data.getvalue()).hexdigest()
+        digest = sha1()
+        for i in range(0, self.length, self.CHUNK_SIZE):
+            digest.update(self.map[i:min(self.length, i + self.CHUNK_SIZE)])
+        return digest.hexdigest()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+            self.file = None
+        self.data = StringIO()
+        self.length = 0
+
+    def __reserve(self, size):
+        # Makes room for size bytes
+        if self.map is None:
+            if size <= self.threshold:
+                return
+            self.file = tempfile.TemporaryFile(prefix="wikipediafs-")
+            self.file.write(self.data.getvalue())
+            self.file.truncate(size * 2)
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), size * 2)
+            self.data = None
+        elif size > len(self.map):
+            # Twice as big, so that appending is not quadratic
+            self.map.resize(max(size, len(self.map) * 2))
+
+if __name__ == "__main__":
+    # Compares the buffer with a file, below and above the threshold
+    import os, random
+
+    f = tempfile.TemporaryFile()
+    buf = SpillBuffer(4096)
+    for i in range(2000):
+        offset = random.randint(0, 20000)
+        if random.random() < 0.1:
+            f.truncate(offset)
+            buf.truncate(offset)
+        else:
+            txt = os.urandom(random.randint(0, 3000))
+            f.seek(offset)
+            f.write(txt)
+            buf.write(txt, offset)
+        f.seek(0, 2)
+        assert buf.size() == f.tell()
+        f.seek(offset)
+        assert buf.read(500, offset) == f.read(500)
+    f.seek(0)
+    content = f.read()
+    assert buf.getvalue() == content
+    assert buf.hash() == sha1(content).hexdigest()
+    print "spilled: %s, size: %d, ok" % (buf.map is not None, buf.size())
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, time, threading, tempfile
+from collections import OrderedDict
+from stats import STATS
+from hashlib import sha1
+
+class AttrCache:
+    """
+    Keeps the attributes (existence, size, mtime, revid) of the articles of
+    a site so that getattr can be answered without downloading them.
+    Expired entries are dropped when others are set, and the oldest ones
+    when there are more than max_size.
+    """
+
+    # Titles kept at most
+    MAX_SIZE = 65536
+
+    def __init__(self, cache_time=30, max_size=MAX_SIZE):
+        self.cache_time = cache_time
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # title -> (attributes, time they were set), oldest first
+        self.attrs = OrderedDict()
+
+    def get(self, title):
+        """
+        Returns the attributes of title or None if they are unknown or too
+        old.
+        """
+        self.lock.acquire()
+        try:
+            if self.attrs.has_key(title):
+                attrs, set_time = self.attrs[title]
+                if time.time() - set_time <= self.cache_time:
+                    return attrs
+                self.attrs.pop(title)
+            return None
+        finally:
+            self.lock.release()
+
+    def set(self, title, attrs):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if self.attrs.has_key(title):
+                self.attrs.pop(title)
+            self.attrs[title] = (attrs, now)
+            self.__purge(now)
+        finally:
+            self.lock.release()
+
+    def __purge(self, now):
+        # Must be called with the lock held
+        while len(self.attrs) > 0:
+            title = self.attrs.iterkeys().next()
+            if len(self.attrs) <= self.max_size and \
+               now - self.attrs[title][1] <= self.cache_time:
+                break
+            self.attrs.pop(title)
+
+    def invalidate(self, title):
+        self.lock.acquire()
+        try:
+            if self.attrs.has_key(title):
+                self.attrs.pop(title)
+        finally:
+            self.lock.release()
+
+class DiskCache:
+    """
+    Keeps the wikitext of articles on disk, with their revid and edit time,
+    so that they do not have to be downloaded again after a remount.
+    There is one file per article, named after the SHA-1 of its title.
+    Files are written atomically (temporary file + rename) and checked when
+    read, so that a crash can only lose entries. The least recently used
+    entries are removed when the cache grows bigger than max_size bytes.
+    The mtime of a file is the last time its revision was known to be
+    current.
+    """
+
+    MAGIC = "WFS-CACHE-1"
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # file name -> [size, last used], loaded on first use
+        self.index = None
+        self.size = 0
+
+    def __load_index(self):
+        # Must be called with the lock held
+        if self.index is not None:
+            return
+
+        self.index = {}
+        self.size = 0
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, 0700)
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("."):
+                # temporary file left by a crash
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            self.index[name] = [st.st_size, st.st_atime]
+            self.size += st.st_size
+
+    def __file_name(self, title):
+        return sha1(title).hexdigest()
+
+    def get(self, title):
+        """
+        Returns a dictionary with the content, revid, edittime and
+        validated (time) of title, or None if it is not cached.
+        """
+        self.lock.acquire()
+        try:
+            self.__load_index()
+            name = self.__file_name(title)
+            if not self.index.has_key(name):
+                return None
+            path = os.path.join(self.directory, name)
+
+            try:
+                f = open(path, "rb")
+                try:
+                    data = f.read()
+                    validated = os.fstat(f.fileno()).st_mtime
+                finally:
+                    f.close()
+                header, content = data.split("\n\n", 1)
+                magic, entry_title, revid, edittime, length = \
+                    header.split("\n")
+                if magic != self.MAGIC or entry_title != title or \
+                   int(length) != len(content):
+                    raise ValueError
+            except (IOError, OSError, ValueError):
+                # Unreadable or truncated entry
+                self.__remove(name)
+                return None
+
+            now = time.time()
+            self.index[name][1] = now
+            os.utime(path, (now, validated))
+
+            return {
+                "content" : content,
+                "revid" : int(revid),
+                "edittime" : edittime,
+                "validated" : validated
+            }
+        finally:
+            self.lock.release()
+
+    def set(self, title, content, revid, edittime):
+        header = "\n".join((self.MAGIC, title, str(revid), str(edittime),
+                            str(len(content))))
+        data = header + "\n\n" + content
+
+        if len(data) > self.max_size:
+            return
+
+        self.lock.acquire()
+        try:
+            self.__load_index()
+            name = self.__file_name(title)
+
+            fd, tmp = tempfile.mkstemp(prefix=".", dir=self.directory)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.rename(tmp, os.path.join(self.directory, name))
+
+            if self.index.has_key(name):
+                self.size -= self.index[name][0]
+            self.index[name] = [len(data), time.time()]
+            self.size += len(data)
+            self.__evict()
+        finally:
+            self.lock.release()
+
+    def validated(self, title):
+        """
+        Records that the cached revision of title is still current.
+        """
+        self.lock.acquire()
+        try:
+            self.__load_index()
+            name = self.__file_name(title)
+            if self.index.has_key(name):
+                try:
+                    os.utime(os.path.join(self.directory, name), None)
+                except OSError:
+                    self.__remove(name)
+        finally:
+            self.lock.release()
+
+    def remove(self, title):
+        self.lock.acquire()
+        try:
+            self.__load_index()
+            self.__remove(self.__file_name(title))
+        finally:
+            self.lock.release()
+
+    def __remove(self, name):
+        # Must be called with the lock held
+        if self.index.has_key(name):
+            self.size -= self.index.pop(name)[0]
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def __evict(self):
+        # Must be called with the lock held
+        if self.size <= self.max_size:
+            return
+
+        entries = [(last_used, name) for name, (size, last_used)
+                   in self.index.items()]
+        entries.sort()
+        for last_used, name in entries:
+            if self.size <= self.max_size:
+                break
+            self.__remove(name)
+
+class MemoryBudget:
+    """
+    Limits the memory used by the articles of all the sites: when their
+    contents take more than max_size bytes, the least recently used
+    article of all the MemoryCache objects is forgotten.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # Shared by all the caches
+        self.lock = threading.RLock()
+        self.caches = []
+
+    def add(self, cache):
+        self.lock.acquire()
+        try:
+            self.caches.append(cache)
+        finally:
+            self.lock.release()
+
+    def size(self):
+        size = 0
+        for cache in self.caches:
+            size += cache.size
+        return size
+
+    def check(self):
+        # Must be called with the lock held
+        while self.max_size > 0 and self.size() > self.max_size:
+            oldest = None
+            for cache in self.caches:
+                last_used = cache.oldest()
+                if last_used is not None and \
+                   (oldest is None or last_used < oldest[0]):
+                    oldest = (last_used, cache)
+            if oldest is None:
+                break # everything is pinned
+            oldest[1].evict()
+
+MEMORY_BUDGET = MemoryBudget(64 * 1024 * 1024)
+
+class MemoryCache:
+    """
+    Article objects of a site by title, in least recently used order.
+    Articles are forgotten when their contents take more than max_size
+    bytes (0 for no limit) or when the global budget is exceeded, unless
+    they are pinned (opened or dirty).
+    """
+
+    def __init__(self, max_size=0, budget=MEMORY_BUDGET, stats_group=None):
+        self.max_size = max_size
+        self.budget = budget
+        self.lock = budget.lock
+        self.stats_group = stats_group
+
+        # title -> [article, size, last used], least recently used first
+        self.entries = OrderedDict()
+        self.pins = {}
+        self.size = 0
+
+        budget.add(self)
+
+    def get(self, title):
+        self.lock.acquire()
+        try:
+            if not self.entries.has_key(title):
+                return None
+            entry = self.entries.pop(title)
+            entry[2] = time.time()
+            self.entries[title] = entry
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def peek(self, title):
+        """
+        Same as get but does not count as a use.
+        """
+        self.lock.acquire()
+        try:
+            if self.entries.has_key(title):
+                return self.entries[title][0]
+            return None
+        finally:
+            self.lock.release()
+
+    def has_key(self, title):
+        return self.entries.has_key(title)
+
+    def titles(self):
+        self.lock.acquire()
+        try:
+            return self.entries.keys()
+        finally:
+            self.lock.release()
+
+    def set(self, title, art):
+        self.lock.acquire()
+        try:
+            self.__remove(title)
+            self.entries[title] = [art, 0, time.time()]
+            self.update(title)
+        finally:
+            self.lock.release()
+
+    def update(self, title):
+        """
+        Accounts for the new content of an article.
+        """
+        self.lock.acquire()
+        try:
+            if not self.entries.has_key(title):
+                return
+            entry = self.entries[title]
+            size = len(entry[0].content)
+            self.size += size - entry[1]
+            entry[1] = size
+            if self.stats_group is not None:
+                STATS.set(self.stats_group, "memory_bytes", self.size)
+
+            while self.max_size > 0 and self.size > self.max_size and \
+                  self.oldest() is not None:
+                self.evict()
+            self.budget.check()
+        finally:
+            self.lock.release()
+
+    def pop(self, title):
+        self.lock.acquire()
+        try:
+            return self.__remove(title)
+        finally:
+            self.lock.release()
+
+    def __remove(self, title):
+        if self.entries.has_key(title):
+            entry = self.entries.pop(title)
+            self.size -= entry[1]
+            if self.stats_group is not None:
+                STATS.set(self.stats_group, "memory_bytes", self.size)
+            return entry[0]
+        return None
+
+    def discard(self, title):
+        """
+        Same as pop, unless title is pinned.
+        """
+        self.lock.acquire()
+        try:
+            if not self.pins.has_key(title):
+                self.__remove(title)
+        finally:
+            self.lock.release()
+
+    def pin(self, title):
+        self.lock.acquire()
+        try:
+            self.pins[title] = self.pins.get(title, 0) + 1
+        finally:
+            self.lock.release()
+
+    def unpin(self, title):
+        self.lock.acquire()
+        try:
+            if self.pins.has_key(title):
+                self.pins[title] -= 1
+                if self.pins[title] <= 0:
+                    self.pins.pop(title)
+        finally:
+            self.lock.release()
+
+    def __oldest_title(self):
+        for title in self.entries:
+            if not self.pins.has_key(title):
+                return title
+        return None
+
+    def oldest(self):
+        """
+        Returns the last time the least recently used unpinned article was
+        used, or None if there is none.
+        """
+        title = self.__oldest_title()
+        if title is None:
+            return None
+        return self.entries[title][2]
+
+    def evict(self):
+        title = self.__oldest_title()
+        if title is not None:
+            size = self.entries[title][1]
+            self.__remove(title)
+            if self.stats_group is not None:
+                STATS.incr(self.stats_group, "memory_evictions")
+                STATS.incr(self.stats_group, "memory_evicted_bytes", size)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, time, threading, tempfile
+from stats import STATS
+from logger import LOGGER
+
+class ChangesPoller:
+    """
+    Follows the recent changes of a site in the background, so that its
+    caches are kept up to date even with a long article cache time.
+    Every interval seconds, the changes made since the last one seen are
+    asked to the backend and passed to site.changed.
+    The position of the last change seen (its time and rcid) is kept in
+    state_file: the changes made while the file system was not mounted
+    are then applied to the disk cache on the next mount. Without a
+    position, changes are followed from cache time seconds ago, since the
+    copies validated before may not be trusted anyway.
+    """
+
+    MAGIC = "WFS-CHANGES-1"
+
+    def __init__(self, site, interval=60, state_file=None):
+        self.site = site
+        self.interval = interval
+        self.state_file = state_file
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+
+        # Position of the last change seen
+        self.timestamp = None
+        self.rcid = 0
+        self.__load()
+        if self.timestamp is None:
+            self.timestamp = time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ",
+                time.gmtime(time.time() - site.cache_time))
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.running = False
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def poll(self):
+        """
+        Applies the changes made since the last one seen. Returns their
+        number, or None if the backend cannot tell them.
+        """
+        count = 0
+        cont = None
+        while True:
+            result = self.site.backend.recent_changes(self.site,
+                                                      self.timestamp, cont)
+            if result is None:
+                return None
+            STATS.incr(self.site.host, "changes_requests")
+            changes, cont = result
+
+            position = (self.timestamp, self.rcid)
+            for change in changes:
+                # The changes made at the time of the last one seen are
+                # listed again
+                if (change["timestamp"], change["rcid"]) <= position:
+                    continue
+                self.site.changed(change)
+                self.timestamp = change["timestamp"]
+                self.rcid = change["rcid"]
+                count += 1
+
+            if (self.timestamp, self.rcid) != position:
+                self.__save()
+            if cont is None:
+                break
+
+        STATS.incr(self.site.host, "changes", count)
+        return count
+
+    def __run(self):
+        while True:
+            try:
+                if self.poll() is None:
+                    LOGGER.warning("Recent changes of %s cannot be "
+                                   "followed" % self.site.host)
+                    return
+            except Exception, e:
+                # Tried again next time, from the same position
+                LOGGER.error("Cannot get the recent changes of %s: %s" %
+                             (self.site.host, e))
+
+            self.cond.acquire()
+            try:
+                if self.running:
+                    self.cond.wait(self.interval)
+                if not self.running:
+                    return
+            finally:
+                self.cond.release()
+
+    def __load(self):
+        if self.state_file is None:
+            return
+        try:
+            f = open(self.state_file, "rb")
+            try:
+                magic, timestamp, rcid = f.read().split("\n")[0:3]
+            finally:
+                f.close()
+            if magic != self.MAGIC:
+                raise ValueError
+            self.rcid = int(rcid)
+            self.timestamp = timestamp
+        except (IOError, OSError, ValueError):
+            pass
+
+    def __save(self):
+        if self.state_file is None:
+            return
+        directory = os.path.dirname(self.state_file)
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory, 0700)
+            fd, tmp = tempfile.mkstemp(prefix=".", dir=directory)
+            try:
+                os.write(fd, "\n".join((self.MAGIC, self.timestamp,
+                                        str(self.rcid), "")))
+            finally:
+                os.close(fd)
+            os.rename(tmp, self.state_file)
+        except (IOError, OSError), e:
+            LOGGER.error("Cannot save the position in the recent changes "
+                         "of %s: %s" % (self.site.host, e))
@@ -17,8 +17,8 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os
-from xml.dom import minidom
+import os, threading
+from xml.etree import cElementTree
 
 class Config:
     """
@@ -26,13 +26,57 @@ class Config:
     Creates the configuration files if needed.
     """
 
+    # Elements of a site entry
+    SITE_KEYS = ("dirname", "host", "basename", "username", "password",
+                 "https", "port", "domain", "httpauth_username",
+                 "httpauth_password", "cookie_str", "api", "fetch_backend",
+                 "memory_cache_size", "recent_changes", "read_ahead",
+                 "read_ahead_threads", "read_ahead_depth", "kernel_cache")
+
     DEFAULT = """\
 <?xml version="1.0" encoding="UTF-8"?>
 <wfs-config>
     <general>
-        <!-- Cache time in seconds -->
+        <!-- Cache time in seconds. It can be much longer for the sites
+             whose recent changes are followed (see recent_changes
+             below) -->
         <article-cache-time>30</article-cache-time>
+        <!-- Lifetime of the login cookies which do not tell it, kept in
+             ~/.wikipediafs/sessions/ -->
         <login-cache-time>7200</login-cache-time>
+        <!-- How long the list of the articles of a directory is kept -->
+        <listing-cache-time>300</listing-cache-time>
+        <!-- How long articles which do not exist are remembered -->
+        <missing-cache-time>60</missing-cache-time>
+        <!-- Idle HTTP connections kept per site, and for how long -->
+        <connection-pool-size>4</connection-pool-size>
+        <connection-idle-time>15</connection-idle-time>
+        <!-- Size in MB of the article cache kept in ~/.wikipediafs/cache/,
+             0 to disable it -->
+        <disk-cache-size>50</disk-cache-size>
+        <!-- Size in MB of the articles of all the sites kept in memory -->
+        <memory-cache-size>64</memory-cache-size>
+        <!-- Size in KB above which opened files are kept in temporary
+             files instead of memory -->
+        <buffer-spill-size>1024</buffer-spill-size>
+        <!-- Editor files (swap and backup files) are forgotten when they
+             have not been opened for this many seconds -->
+        <editor-file-time>3600</editor-file-time>
+        <!-- How long the kernel keeps the attributes of the files, the
+             names of the files and the names which do not exist, without
+             asking WikipediaFS again (for all the sites) -->
+        <kernel-attr-timeout>1</kernel-attr-timeout>
+        <kernel-entry-timeout>1</kernel-entry-timeout>
+        <kernel-negative-timeout>0</kernel-negative-timeout>
+        <!-- Uncomment to upload saved articles in the background: edits
+             are journaled in ~/.wikipediafs/journal/ until they are
+             uploaded, and retried at most every write-back-max-delay
+             seconds if they fail -->
+        <!-- <write-back /> -->
+        <write-back-max-delay>300</write-back-max-delay>
+        <!-- Uploads at a time when edits are published (see the
+             publish.txt file at the root, and the offline mount option) -->
+        <publish-threads>4</publish-threads>
     </general>
     <sites>
         <!-- 
@@ -55,6 +99,14 @@ class Config:
             <httpauth_password>Password</httpauth_password>
             <cookie_str>cookie_name=cookie_value</cookie_str>
             <domain>DOMAIN (if using LDAP/AD Authentication extension)</domain>
+            <api>/w/api.php</api>
+            <fetch_backend>auto, api or edit</fetch_backend>
+            <memory_cache_size>Size in MB</memory_cache_size>
+            <recent_changes>Seconds between two polls</recent_changes>
+            <read_ahead>Linked articles got ahead per article</read_ahead>
+            <read_ahead_threads>2</read_ahead_threads>
+            <read_ahead_depth>1</read_ahead_depth>
+            <kernel_cache>yes or no</kernel_cache>
         </site>
         -->        
         <!--
@@ -83,12 +135,30 @@ class Config:
             
         # Loads the config from a file or from a string    
         if(not config_str):            
-            self.__config = minidom.parse(self.conf_file).documentElement
+            self.__config = cElementTree.parse(self.conf_file).getroot()
         else:
-            self.__config = minidom.parseString(config_str).documentElement
-                            
+            self.__config = cElementTree.fromstring(config_str)
+
+        # Options (the elements outside of <sites>) by tag, so that each of
+        # them is found without going through all the sites
+        self.__options = {}
+        for child in self.__config:
+            if child.tag == "sites":
+                continue
+            for element in child.getiterator():
+                if not self.__options.has_key(element.tag):
+                    self.__options[element.tag] = element
+
         self.__setCacheTimes()
 
+        self.__setConnectionPool()
+
+        self.__setCacheSizes()
+
+        self.__setKernelCache()
+
+        self.__setWriteBack()
+
         self.__setDebug()
             
         self.__setSites()
@@ -107,46 +177,95 @@ class Config:
 
     def __setSites(self):
         self.sites = {}
-        sites = self.__config.getElementsByTagName("site")
-        for site in sites:
-             dic = {}
-             for ele in ("dirname", "host", "basename", "username",
-             "password", "https", "port", "domain", "httpauth_username",
-             "httpauth_password", "cookie_str"):
-                node = site.getElementsByTagName(ele)
-                if node.length == 1:
-                    if node[0].firstChild:
-                        dic[ele] = node[0].firstChild.nodeValue.encode("utf-8")
-                    else:
-                        dic[ele] = True # for elements like <https />
+        for site in self.__config.getiterator("site"):
+             dic = dict.fromkeys(Config.SITE_KEYS)
+             seen = {}
+             for element in site.getiterator():
+                if not dic.has_key(element.tag):
+                    continue
+                if seen.has_key(element.tag):
+                    dic[element.tag] = None # given twice: ignored
+                elif element.text:
+                    dic[element.tag] = element.text.encode("utf-8")
                 else:
-                    dic[ele] = None
+                    dic[element.tag] = True # for elements like <https />
+                seen[element.tag] = True
                     
              self.sites[dic["dirname"]] = dic
 
 
     def __setCacheTimes(self):
-        element = self.__config.getElementsByTagName("article-cache-time")
-        if element.length == 0:
-            self.cache_time = 30
-        else:
-            self.cache_time = int(str(element[0].firstChild.nodeValue))
-        element = self.__config.getElementsByTagName("login-cache-time")
-        if element.length == 0:
-            self.login_cache_time = 7200
+        self.cache_time = self.__getInt("article-cache-time", 30)
+        self.login_cache_time = self.__getInt("login-cache-time", 7200)
+        self.listing_cache_time = self.__getInt("listing-cache-time", 300)
+        self.missing_cache_time = self.__getInt("missing-cache-time", 60)
+
+    def __getInt(self, tag, default):
+        if not self.__options.has_key(tag):
+            return default
         else:
-            self.login_cache_time = int(str(element[0].firstChild.nodeValue))
+            return int(str(self.__options[tag].text))
+
+    def __setConnectionPool(self):
+        self.pool_size = self.__getInt("connection-pool-size", 4)
+        self.pool_idle_time = self.__getInt("connection-idle-time", 15)
+
+    def __setCacheSizes(self):
+        size = self.__getInt("disk-cache-size", 50)
+        self.disk_cache_size = size * 1024 * 1024
+        size = self.__getInt("memory-cache-size", 64)
+        self.memory_cache_size = size * 1024 * 1024
+        self.spill_size = self.__getInt("buffer-spill-size", 1024) * 1024
+        self.editor_file_time = self.__getInt("editor-file-time", 3600)
+
+    def __setKernelCache(self):
+        self.kernel_attr_timeout = self.__getInt("kernel-attr-timeout", 1)
+        self.kernel_entry_timeout = self.__getInt("kernel-entry-timeout", 1)
+        self.kernel_negative_timeout = \
+            self.__getInt("kernel-negative-timeout", 0)
+
+    def __setWriteBack(self):
+        self.write_back = self.__options.has_key("write-back")
+        self.write_back_max_delay = self.__getInt("write-back-max-delay", 300)
+        self.publish_threads = self.__getInt("publish-threads", 4)
 
     def __setDebug(self):
-        element = self.__config.getElementsByTagName("debug")
-        if element.length == 0:
-            self.debug_mode = False
-        else:
-            self.debug_mode = True                        
+        self.debug_mode = self.__options.has_key("debug")
+        
+class LazyConfig:
+    """
+    Stands for the Config of ~/.wikipediafs/config.xml, which is only read
+    (and created if needed) when one of its values is first used, so that
+    importing WikipediaFS does nothing.
+    """
+
+    def __init__(self):
+        self.__config = None
+        self.__lock = threading.Lock()
+
+    def load(self, config_str=False):
+        """
+        Reads the configuration (again).
+        """
+        config = Config(config_str)
+        self.__config = config
+        return config
+
+    def __getattr__(self, name):
+        config = self.__config
+        if config is None:
+            self.__lock.acquire()
+            try:
+                config = self.__config
+                if config is None:
+                    config = self.load()
+            finally:
+                self.__lock.release()
+        return getattr(config, name)
         
         
 if __name__ != "__main__":
-    CONFIG = Config()
+    CONFIG = LazyConfig()
 else:    
     config_test = """\
 <?xml version="1.0" encoding="UTF-8"?>
@@ -179,5 +298,6 @@ else:
     config = Config(config_test)
     print "cache time:", config.cache_time
     print "debug:", config.debug_mode
+    print "connection pool:", config.pool_size, config.pool_idle_time
     for k, v in config.sites.items():
         print k, v        
@@ -17,26 +17,83 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os.path, re, time
+import os.path, re, time, errno, threading
 from metadir import MetaDir
 from config import CONFIG
-from article import Article
-from user import User
-from logger import LOGGER
+from article import SESSION_EXPIRED, EDIT_CONFLICT, \
+     PERMISSION_DENIED, SERVER_ERROR
+from logger import LOGGER, set_debug
+from http import POOL
+from cache import MEMORY_BUDGET
+from stats import STATS
+from wiki import Site
+from backend import new_attrs, edittime_to_mtime, CATEGORY
+from writeback import Journal, WriteBackQueue, CONFLICT, REJECTED
+from changes import ChangesPoller
 
 class ArticleDir:
-    def __init__(self, fs, config):
+    # Saves failing with a server error are tried again SAVE_RETRIES times,
+    # after SAVE_RETRY_DELAY seconds, then twice as long each time
+    SAVE_RETRIES = 3
+    SAVE_RETRY_DELAY = 1
+
+    # Held while the Site of a directory is created
+    SITE_LOCK = threading.Lock()
+
+    def __init__(self, fs, config, site=None):
         self.fs = fs
         self.config = config
-        self.login_time = 0
 
-        self.files = {}
+        # Shared by the site root directory and its subdirectories,
+        # created by __getattr__ when it is first used
+        if site is not None:
+            self.site = site
+
+        # Articles are kept in self.site.articles
         self.dirs = {}
+        # Category directories found to exist (they are not listed)
+        self.categories = {}
+
+    def __getattr__(self, name):
+        # Only called for the attributes which are not set yet
+        if name != "site":
+            raise AttributeError, name
+        ArticleDir.SITE_LOCK.acquire()
+        try:
+            if self.__dict__.has_key("site"):
+                return self.__dict__["site"]
+            config = self.config
+            cache_dir = os.path.join(CONFIG.home_dir, "cache",
+                                     config.get("dirname") or config["host"])
+            site = Site(config, CONFIG.cache_time, LOGGER,
+                        cache_dir, CONFIG.disk_cache_size,
+                        os.path.join(CONFIG.home_dir, "sessions"),
+                        CONFIG.login_cache_time, CONFIG.listing_cache_time,
+                        CONFIG.missing_cache_time)
+            site.offline = bool(self.fs.offline)
+            self.site = site
+            return site
+        finally:
+            ArticleDir.SITE_LOCK.release()
+
+    def get_key(self, path):
+        # Path of an article in the write-back queue
+        return path.replace(" ", "_")
+
+    def pending(self, path):
+        # Edit of path waiting to be uploaded in write-back mode
+        if self.fs.writeback is None:
+            return None
+        return self.fs.writeback.pending(self.get_key(path))
 
     def get_article_full_name(self, path):
         # Returns article name. This can include subpages.
         return '/'.join(path.split("/")[2:])
 
+    def get_title(self, path):
+        # Article name as used by Mediawiki, without .mw
+        return self.get_article_full_name(path)[0:-3].replace(" ", "_")
+
     def get_article_file_name(self, path):
         # File name as used in the directory i.e. without the subpages.
         return os.path.basename(path)
@@ -53,87 +110,247 @@ class ArticleDir:
         else:
             return False
 
+    def get_dir_title(self, path):
+        # Title of the directory, i.e. of the parent of its subpages
+        return '/'.join(path.split("/")[2:]).replace(" ", "_")
+
     def contents(self, path):
         arr = self.dirs.keys()
-        for k in self.files.keys():
-            if not self.files[k].is_empty:
-                arr.append(k)
-        return arr
+
+        prefix = self.get_dir_title(path)
+        if prefix:
+            prefix += "/"
+        for title in self.site.articles.titles():
+            name = title[len(prefix):]
+            if title.startswith(prefix) and name.count("/") == 0:
+                art = self.site.articles.peek(title)
+                if art is not None and not art.is_empty:
+                    arr.append(name + ".mw")
+
+        # The names given so far, so that the articles of the site (maybe
+        # many more) are each checked in constant time
+        names = dict.fromkeys(arr, True)
+
+        if self.fs.writeback is not None:
+            # Articles created but not uploaded yet
+            for key in self.fs.writeback.paths():
+                name = os.path.basename(key)
+                if os.path.dirname(key) == self.get_key(path) and \
+                   not names.has_key(name):
+                    arr.append(name)
+                    names[name] = True
+
+        # ls -l will call getattr on each file: get all their attributes
+        # with a few requests beforehand
+        self.site.prefetch([self.get_title(os.path.join(path, k))
+                            for k in arr if self.is_valid_file(k)])
+        for name in arr:
+            yield name
+
+        # Then the articles of the site, one batch at a time (their
+        # attributes come with them)
+        for title in self.site.list_pages(prefix):
+            name = title[len(prefix):] + ".mw"
+            if title.startswith(prefix) and name.count("/") == 0 and \
+               not names.has_key(name):
+                yield name
             
     def is_directory(self, path):
         name = self.get_article_file_name(path)
-        return self.dirs.has_key(name)
+        if self.dirs.has_key(name) or self.categories.has_key(name):
+            return True
+        if self.is_category(path) and self.category_exists(name):
+            # Category directories are there as soon as they are looked for
+            self.categories[name] = True
+            self.fs.set_dir(path, CategoryDir(self.fs, self.config,
+                                              self.site))
+            return True
+        return False
+
+    def category_exists(self, name):
+        # A category exists if it has a page or members
+        title = name.replace(" ", "_")
+        if self.site.missing.get(title):
+            return False
+        attrs = self.site.stat(title)
+        if attrs is not None and attrs["exists"]:
+            return True
+        members = self.site.has_members(title)
+        if members or (attrs is None and members is None):
+            # It may exist, as far as the backend can tell
+            self.site.missing.invalidate(title)
+            return True
+        self.site.not_found(title)
+        return False
+
+    def is_category(self, path):
+        # Category:Name directories are at the root of the site
+        name = self.get_article_file_name(path)
+        return path.count("/") == 2 and name.startswith(CATEGORY) and \
+               len(name) > len(CATEGORY) and name[-3:] != ".mw"
 
     def is_file(self, path):
         if self.is_valid_file(path):
+            attrs = self.get_attrs(path)
+            if attrs is not None:
+                return attrs["exists"] and attrs["size"] > 0
             txt = self.read_file(path)
             if len(txt.strip()) == 0:
+                if self.pending(path) is None:
+                    self.site.not_found(self.get_title(path))
                 return False
             else:
                 return True
         else:
             return False
 
-    def set_cookie_string(self, force):
-        if force or not self.config.has_key("cookie_str"):
-            if self.config["username"] is not None and \
-               self.config["password"] is not None:
-                user = User(logger=LOGGER, **self.config)
-                cookie_str = user.getCookieString()
-                self.config["cookie_str"] = cookie_str
-
-            self.login_time = time.time()
+    def get_attrs(self, path):
+        # Attributes of an article, without downloading it when the site
+        # backend can tell them
+        entry = self.pending(path)
+        if entry is not None:
+            return new_attrs(len(entry["content"]) > 0,
+                             len(entry["content"]), entry["modified"])
+        return self.site.stat(self.get_title(path))
 
     def get_art(self, path):
-        file_name = self.get_article_file_name(path)
-        full_name = self.get_article_full_name(path)
+        return self.site.article(self.get_title(path))
 
-        if int(time.time()) - self.login_time > CONFIG.login_cache_time:
-            self.set_cookie_string(1)
-        else:
-            if self.files.has_key(file_name):
-                return self.files[file_name]
-            else:
-                self.set_cookie_string(0)
+    def created(self, path):
+        # The article may have been created since it was looked for
+        self.site.missing.invalidate(self.get_title(path))
 
-        art = Article(full_name[0:-3], # removes .mw from the name
-                      cache_time=CONFIG.cache_time,
-                      logger = LOGGER,
-                      **self.config)
-        self.files[file_name] = art
+    def kernel_cache(self, path):
+        # Whether the kernel may keep the pages of unchanged articles (not
+        # of the ones whose edit waits to be uploaded: their revision does
+        # not change when they are written)
+        return self.config.get("kernel_cache") != "no" and \
+               self.pending(path) is None
 
-        return art
+    def pin(self, path):
+        # Opened articles must stay in memory
+        if self.is_valid_file(path):
+            self.site.articles.pin(self.get_title(path))
+
+    def unpin(self, path):
+        if self.is_valid_file(path):
+            self.site.articles.unpin(self.get_title(path))
+
+    def revision(self, path):
+        # Revision of the article as it was last read or saved
+        art = self.site.articles.peek(self.get_title(path))
+        if art is not None:
+            return art.revid
+        return None
 
     def read_file(self, path):
+        entry = self.pending(path)
+        if entry is not None:
+            return entry["content"]
         art = self.get_art(path)
-        txt = art.get()
-        return txt
+        return self.site.get_article(self.get_title(path), art)
 
     def write_to(self, path, txt):
+        # Without write-back, only the files whose journaled edit is still
+        # waiting are queued again (or it would be uploaded over this one)
+        if self.fs.writeback is not None and \
+           (CONFIG.write_back or self.fs.offline or
+            self.pending(path) is not None):
+            try:
+                self.fs.writeback.put(self.get_key(path), txt,
+                                      self.revision(path))
+            except (IOError, OSError), e:
+                LOGGER.error("Cannot journal %s: %s" % (path, e))
+                return False
+            return True
+
+        ret = self.upload(path, txt)
+        if ret == CONFLICT:
+            return -errno.EBUSY
+        elif ret == REJECTED:
+            return -errno.EACCES
+        return ret
+
+    def upload(self, path, txt, revid=None, force=False):
+        # Returns True, False, CONFLICT if the article was changed since
+        # revision revid (or by another user while it was saved), or
+        # REJECTED if the user is not allowed to save it.
+        # With force, the article is saved whatever its current revision.
         art = self.get_art(path)
-        ret = art.set(txt)
-        if (ret == False):
-            self.set_cookie_string(1)
+        if revid is not None and not force:
+            title = self.get_title(path)
+            attrs = (self.site.backend.stat(self.site, [title]) or {})
+            if attrs.has_key(title) and attrs[title]["revid"] != revid:
+                return CONFLICT
+
+        art.lock.acquire()
+        try:
+            # The edit form sent back (wpEdittime) must be the one of the
+            # revision the edit is made from, or the server reports a
+            # conflict
+            if force:
+                # The current one
+                stale = True
+            elif revid is not None:
+                # The current one too, as checked above
+                stale = art.last_get == 0 or art.revid != revid
+            else:
+                # Unknown: edits replayed from the journal are saved over
+                # the current revision if the article was never got
+                stale = art.wpEdittime == 0
+            if stale:
+                art.last_get = 0
+                art.get()
+                if not force and revid is not None and \
+                   art.revid is not None and art.revid != revid:
+                    # Changed since it was checked
+                    return CONFLICT
             ret = art.set(txt)
-
+            relogged = False
+            retries = 0
+            while ret == False:
+                STATS.incr(self.site.host, "save_errors_%s" % art.error)
+                if art.error == SESSION_EXPIRED and not relogged:
+                    # The session logs in again on the next request
+                    relogged = True
+                elif art.error == SERVER_ERROR and \
+                     retries < self.SAVE_RETRIES:
+                    time.sleep(self.SAVE_RETRY_DELAY * 2 ** retries)
+                    retries += 1
+                    STATS.incr(self.site.host, "save_retries")
+                else:
+                    break
+                ret = art.set(txt)
+
+            if ret:
+                self.site.article_saved(self.get_title(path), art)
+            else:
+                self.site.attrs.invalidate(self.get_title(path))
+        finally:
+            art.lock.release()
+
+        if ret == False and art.error == EDIT_CONFLICT:
+            return CONFLICT
+        elif ret == False and art.error == PERMISSION_DENIED:
+            return REJECTED
         return ret
 
     def size(self, path):
         LOGGER.debug("FSdir size %s" % (path))
+        attrs = self.get_attrs(path)
+        if attrs is not None:
+            return attrs["size"]
         return len(self.read_file(path))
 
     def mtime(self, path):
+        attrs = self.get_attrs(path)
+        if attrs is not None:
+            return attrs["mtime"]
+
         art = self.get_art(path)
         # Do a get here just so we have a current Edittime.
         art.get()
-        tmp = art.wpEdittime
-        t = time.mktime((int(tmp[0:4]), int(tmp[4:6]), int(tmp[6:8]), int(tmp[8:10]), int(tmp[10:12]), int(tmp[12:21]), 0, 0, -1))
-        if time.daylight:
-            t -= time.altzone
-        else:
-            t -= time.timezone
-
-        return t
+        return edittime_to_mtime(art.wpEdittime)
                     
     def mode(self, path):
         LOGGER.debug("FSdir mode %s" % (path))
@@ -141,9 +358,10 @@ class ArticleDir:
                  
     def unlink(self, path):
         LOGGER.debug("FSdir unlink %s" % (path))
-        file_name = self.get_article_file_name(path)
-        if self.files.has_key(file_name):
-            self.files.pop(file_name)
+        if self.fs.writeback is not None:
+            # Forgets the edit which was not uploaded yet
+            self.fs.writeback.drop(self.get_key(path))
+        if self.site.articles.pop(self.get_title(path)) is not None:
             return True # succeeded
         else:
             return False
@@ -152,10 +370,52 @@ class ArticleDir:
         LOGGER.debug("FSdir mkdir %s" % (path))
         name = self.get_article_file_name(path)
         self.dirs[name] = True        
-        self.fs.set_dir(path, ArticleDir(self.fs, self.config))
+        self.fs.set_dir(path, ArticleDir(self.fs, self.config, self.site))
         return True                               
 
+class CategoryDir(ArticleDir):
+    """
+    Members of a category: its articles (Name.mw, the name including the
+    namespace but in the main one) and its subcategories (Category:Name
+    directories). They are the same articles as in the directory of the
+    site.
+    """
+
+    def get_article_full_name(self, path):
+        return os.path.basename(path)
+
+    def get_key(self, path):
+        # Path of the article in the directory of the site
+        return "/%s/%s" % (path.split("/")[1],
+                           os.path.basename(path).replace(" ", "_"))
+
+    def contents(self, path):
+        category = os.path.basename(path).replace(" ", "_")
+        for title in self.site.list_members(category):
+            if title.startswith(CATEGORY):
+                yield title
+            elif title.count("/") == 0:
+                # Subpages cannot be named in a directory
+                yield title + ".mw"
+
+    def is_category(self, path):
+        name = self.get_article_file_name(path)
+        return name.startswith(CATEGORY) and len(name) > len(CATEGORY) \
+               and name[-3:] != ".mw"
+
+    def mkdir(self, path):
+        # Categories are not created from here
+        return False
+
 class Root:
+    # Read-only file showing the counters of the caches and pools
+    STATS_FILE = "stats.txt"
+    # Read-only file showing the edits waiting to be uploaded
+    # (in write-back and offline modes)
+    WRITEBACK_FILE = "writeback.txt"
+    # Control file of the waiting edits: see WikipediaFS.publish
+    PUBLISH_FILE = "publish.txt"
+
     def __init__(self, fs):
         self.fs = fs
         self.dirs = {}
@@ -170,10 +430,15 @@ class Root:
 
     def contents(self, path):
         if path == "/":
-            return self.dirs.keys()
+            return self.dirs.keys() + self.files()
         else:
             return []
 
+    def files(self):
+        if self.fs.writeback is not None:
+            return [Root.STATS_FILE, Root.WRITEBACK_FILE, Root.PUBLISH_FILE]
+        return [Root.STATS_FILE]
+
     def is_directory(self, path):
         basename = os.path.basename(path)
         if path == "/" or self.dirs.has_key(basename):
@@ -182,10 +447,40 @@ class Root:
             return False
 
     def is_file(self, path):
-        return False # There is no file at the root
+        # There is no file at the root but the stats files
+        return self.files().count(path[1:]) == 1
+
+    def is_valid_file(self, path):
+        return False # Files cannot be created at the root
+
+    def read_file(self, path):
+        if path == "/" + Root.STATS_FILE:
+            return STATS.dump()
+        elif self.is_file(path) and path == "/" + Root.WRITEBACK_FILE:
+            return self.fs.writeback.status()
+        else:
+            # publish.txt is only written to: the status is in writeback.txt
+            return ""
+
+    def write_to(self, path, txt):
+        if self.is_file(path) and path == "/" + Root.PUBLISH_FILE:
+            self.fs.publish(txt)
+            return True
+        return False
+
+    def size(self, path):
+        return len(self.read_file(path))
+
+    def mtime(self, path):
+        return time.time()
 
     def mode(self, path):
-        return 0755
+        if self.is_file(path) and path == "/" + Root.PUBLISH_FILE:
+            return 0644
+        elif self.is_file(path):
+            return 0444
+        else:
+            return 0755
 
     def mkdir(self, path):
         # add a site from the wikimedia foundation
@@ -213,14 +508,189 @@ class Root:
 class WikipediaFS(MetaDir):
     def __init__(self, *arr, **dic):
         MetaDir.__init__(self, *arr, **dic)
+
+        # Single threaded unless mounted with -o multithreaded
+        # (use parse(values=self))
+        self.multithreaded = 0
+        self.parser.add_option(mountopt="multithreaded",
+                               action="store_true",
+                               help="serve several requests at a time")
+        # Articles are read from the caches and edits are kept until they
+        # are published (see publish)
+        self.offline = 0
+        self.parser.add_option(mountopt="offline",
+                               action="store_true",
+                               help="do not connect until edits are "
+                                    "published")
+
+        set_debug(CONFIG.debug_mode)
+        POOL.max_size = CONFIG.pool_size
+        POOL.idle_time = CONFIG.pool_idle_time
+        MEMORY_BUDGET.max_size = CONFIG.memory_cache_size
+        self.spill_size = CONFIG.spill_size
+        self.editor_file_time = CONFIG.editor_file_time
+
+        # How long the kernel keeps attributes and names, unless they are
+        # given with -o
+        self.fuse_args.add("attr_timeout", str(CONFIG.kernel_attr_timeout))
+        self.fuse_args.add("entry_timeout",
+                           str(CONFIG.kernel_entry_timeout))
+        self.fuse_args.add("negative_timeout",
+                           str(CONFIG.kernel_negative_timeout))
+
+        # Created by fsinit in write-back and offline modes, or when edits
+        # are left in the journal
+        self.writeback = None
+        # Started by fsinit for the sites whose recent changes are followed
+        self.pollers = []
+
         self.set_root(Root(self))
 
+    def fsinit(self):
+        # Called by fuse once the file system is mounted: threads started
+        # earlier would not survive the fork when fuse goes to background
+        if not self.offline:
+            self.follow_changes()
+        journal_dir = os.path.join(CONFIG.home_dir, "journal")
+        if not CONFIG.write_back and not self.offline:
+            # Edits left in the journal by a mount with write-back are
+            # still uploaded (and read back until they are)
+            if not os.path.isdir(journal_dir):
+                return
+            paths = [entry["path"] for entry in Journal(journal_dir).load()]
+            if len(paths) == 0:
+                return
+            LOGGER.warning("Write-back is disabled but edits are journaled, "
+                           "they are uploaded now: %s" % ", ".join(paths))
+
+        # Sites created from now on read self.offline themselves
+        for d in self.dirs.values():
+            if dir(d).count("site") == 1:
+                d.site.offline = bool(self.offline)
+
+        journal = Journal(journal_dir)
+        self.writeback = WriteBackQueue(
+            journal, self.writeback_upload, self.writeback_queued,
+            self.writeback_done, max_delay=CONFIG.write_back_max_delay,
+            hold=bool(self.offline),
+            log_file=os.path.join(CONFIG.home_dir, "publish.log"))
+        self.writeback.start()
+
+    def follow_changes(self):
+        # Starts polling the recent changes of the sites configured to
+        for dirname, config in CONFIG.sites.items():
+            if not config.get("recent_changes"):
+                continue
+            d = self.dirs["/" + dirname]
+            poller = ChangesPoller(d.site, int(config["recent_changes"]),
+                                   os.path.join(CONFIG.home_dir, "changes",
+                                                dirname))
+            poller.start()
+            self.pollers.append(poller)
+
+    def publish(self, commands):
+        """
+        Runs the commands written to publish.txt, one per line:
+        "all" (or nothing at all) publishes all the waiting edits, a path
+        such as "wikipedia-fr/Article.mw" publishes the edit of this file,
+        "force <path>" publishes it even if the article was changed on the
+        server in the meantime and "drop <path>" forgets it.
+        The results are shown in writeback.txt and ~/.wikipediafs/publish.log
+        """
+        if self.writeback is None:
+            return
+
+        threads = CONFIG.publish_threads
+        paths = []
+        publish_all = commands.strip() == ""
+        for line in commands.split("\n"):
+            words = line.split(None, 1)
+            if len(words) == 0:
+                continue
+            elif words == ["all"]:
+                publish_all = True
+            elif words[0] == "force" and len(words) == 2:
+                self.writeback.publish([self.queue_path(words[1])], True,
+                                       threads)
+            elif words[0] == "drop" and len(words) == 2:
+                self.writeback.drop(self.queue_path(words[1]))
+            else:
+                paths.append(self.queue_path(line))
+
+        if publish_all:
+            self.writeback.publish(None, False, threads)
+        elif len(paths) > 0:
+            self.writeback.publish(paths, False, threads)
 
-if __name__ == "__main__":
-    server = WikipediaFS(version="%prog VERSION",
-                     usage='blabla',
-                     dash_s_do='setsingle')
+    def queue_path(self, name):
+        # "wikipedia-fr/An article.mw" -> "/wikipedia-fr/An_article.mw"
+        return "/" + name.strip().lstrip("/").replace(" ", "_")
+
+    def writeback_upload(self, path, txt, revid, force=False):
+        d = self.get_dir(path)
+        if dir(d).count("upload") == 0:
+            LOGGER.error("Cannot upload %s: no such site" % path)
+            return False
+        return d.upload(path, txt, revid, force)
 
-    server.parse(errex=1)
-    server.multithreaded = 0
-    server.main()
+    def writeback_queued(self, path):
+        # Articles waiting to be uploaded must stay in memory
+        d = self.get_dir(path)
+        if dir(d).count("pin") == 1:
+            d.pin(path)
+
+    def writeback_done(self, path):
+        d = self.get_dir(path)
+        if dir(d).count("unpin") == 1:
+            d.unpin(path)
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["--benchmark"]:
+        # Time to mount vs. number of configured sites, in a temporary HOME
+        import tempfile, shutil
+        from config import Config
+
+        home = tempfile.mkdtemp()
+        os.environ["HOME"] = home
+        os.mkdir(os.path.join(home, ".wikipediafs"), 0700)
+        site = "<site><dirname>site%d</dirname><host>wiki%d.example.org" \
+               "</host><basename>/w/index.php</basename></site>\n"
+
+        print "%6s %10s %10s %12s %12s" % ("sites", "parse ms", "mount ms",
+                                          "1st site ms", "all sites ms")
+        for n in (1, 10, 100, 1000):
+            f = open(os.path.join(home, ".wikipediafs", "config.xml"), "w")
+            f.write(Config.DEFAULT.replace(
+                "<sites>", "<sites>" + "".join([site % (i, i)
+                                                for i in range(n - 1)]), 1))
+            f.close()
+
+            start = time.time()
+            CONFIG.load()
+            parsed = time.time()
+            server = WikipediaFS(version="%prog VERSION",
+                                 usage='blabla',
+                                 dash_s_do='setsingle')
+            server.fsinit()
+            mounted = time.time()
+            # What a first lookup in a site directory costs
+            server.get_dir("/mblondel.org/Main_Page.mw").site
+            first = time.time()
+            for dirname in CONFIG.sites.keys():
+                server.get_dir("/%s/Main_Page.mw" % dirname).site
+            done = time.time()
+            print "%6d %10.1f %10.1f %12.1f %12.1f" % (
+                len(CONFIG.sites), (parsed - start) * 1000,
+                (mounted - parsed) * 1000, (first - mounted) * 1000,
+                (done - first) * 1000)
+
+        shutil.rmtree(home)
+    else:
+        server = WikipediaFS(version="%prog VERSION",
+                         usage='blabla',
+                         dash_s_do='setsingle')
+
+        server.parse(values=server, errex=1)
+        server.main()
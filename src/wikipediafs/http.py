@@ -17,14 +17,190 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os, socket, string, base64
+import os, socket, string, base64, time, threading, zlib
 import httplib
+from stats import STATS
+
+class ConnectionPool:
+    """
+    Keeps idle HTTP/1.1 connections alive so that they can be reused by the
+    next request to the same site instead of opening a new TCP connection
+    (and doing a new TLS handshake for https).
+    Connections are grouped by (host, port, https, proxy).
+    """
+
+    def __init__(self, max_size=4, idle_time=15):
+        # maximum number of idle connections kept for a given key
+        self.max_size = max_size
+        # idle connections older than that (in seconds) are closed
+        self.idle_time = idle_time
+
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key, factory):
+        """
+        Returns a tuple (connection, reused).
+        factory is called to create a new connection if none is idle.
+        """
+        conn = None
+        self.lock.acquire()
+        try:
+            self.__evict(time.time())
+            conns = self.idle.get(key)
+            if conns:
+                conn = conns.pop()[0]
+        finally:
+            self.lock.release()
+
+        if conn is None:
+            STATS.incr("http", "connections_new")
+            return (factory(), False)
+        else:
+            STATS.incr("http", "connections_reused")
+            return (conn, True)
+
+    def put(self, key, conn):
+        """
+        Gives back a connection whose last response has been fully read.
+        """
+        if conn.sock is None:
+            # The server asked to close the connection
+            conn.close()
+            return
+
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault(key, [])
+            conns.append((conn, time.time()))
+            while len(conns) > self.max_size:
+                conns.pop(0)[0].close()
+                STATS.incr("http", "connections_evicted")
+        finally:
+            self.lock.release()
+
+    def __evict(self, now):
+        # Must be called with the lock held
+        for key, conns in self.idle.items():
+            alive = []
+            for conn, last_used in conns:
+                if now - last_used > self.idle_time:
+                    conn.close()
+                    STATS.incr("http", "connections_evicted")
+                else:
+                    alive.append((conn, last_used))
+            if alive:
+                self.idle[key] = alive
+            else:
+                self.idle.pop(key)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn, last_used in conns:
+                    conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+POOL = ConnectionPool()
+
+class DecodedResponse:
+    """
+    Wraps an httplib.HTTPResponse and transparently decompresses gzip or
+    deflate encoded bodies as they are read, chunk by chunk.
+    Received and decompressed byte counts are added to the stats of the
+    given group.
+    """
+
+    CHUNK_SIZE = 16384
+
+    def __init__(self, response, stats_group):
+        self.response = response
+        self.stats_group = stats_group
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+        self.encoding = (response.getheader("Content-Encoding") or "")
+        self.encoding = self.encoding.strip().lower()
+        if self.encoding in ("gzip", "x-gzip"):
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self.decoder = zlib.decompressobj()
+        else:
+            self.decoder = None
+        self.decoded_once = False
+
+        self.iterator = self.chunks()
+        self.pending = ""
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def getheaders(self):
+        return self.response.getheaders()
+
+    def isclosed(self):
+        return self.response.isclosed()
+
+    def __decompress(self, data):
+        try:
+            data = self.decoder.decompress(data)
+        except zlib.error:
+            if self.encoding != "deflate" or self.decoded_once:
+                raise
+            # Some servers send raw deflate data without the zlib header
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self.decoder.decompress(data)
+        self.decoded_once = True
+        return data
+
+    def chunks(self, size=CHUNK_SIZE):
+        """
+        Yields the decompressed body, piece by piece.
+        """
+        while True:
+            data = self.response.read(size)
+            if not data:
+                break
+            STATS.incr(self.stats_group, "bytes_compressed", len(data))
+            if self.decoder is not None:
+                data = self.__decompress(data)
+            if data:
+                STATS.incr(self.stats_group, "bytes_decompressed", len(data))
+                yield data
+
+        if self.decoder is not None:
+            data = self.decoder.flush()
+            if data:
+                STATS.incr(self.stats_group, "bytes_decompressed", len(data))
+                yield data
+
+    def read(self, amt=None):
+        parts = [self.pending]
+        length = len(self.pending)
+        for data in self.iterator:
+            parts.append(data)
+            length += len(data)
+            if amt is not None and length >= amt:
+                break
+
+        data = "".join(parts)
+        if amt is None:
+            self.pending = ""
+            return data
+        else:
+            self.pending = data[amt:]
+            return data[:amt]
 
 class ExtendedHTTPConnection:
     """
-    Transparent support for https, proxy, http auth
+    Transparent support for https, proxy, http auth, persistent
+    connections and compressed responses.
     """
-    def __init__(self, host, port=None, https=False):
+    def __init__(self, host, port=None, https=False, pool=POOL):
         if https and not port:
             port = 443
         elif not port:
@@ -35,20 +211,22 @@ class ExtendedHTTPConnection:
         self.https = https
         self.port = port
         self.host = host 
+        self.pool = pool
 
         if os.environ.has_key("http_proxy"):
             self.proxy_enabled = True
-
-            self.conn = self.get_proxy_connection()
+            self.proxy = os.environ["http_proxy"]
         else:
             self.proxy_enabled = False
-            
-            if https:
-                self.conn = httplib.HTTPSConnection(host, port)
-            else:
-                self.conn = httplib.HTTPConnection(host, port)
+            self.proxy = None
 
-        self.headers = {}
+        self.key = (self.host, self.port, self.https, self.proxy)
+        self.conn = None
+        self.reused = False
+        self.response = None
+        self.last_request = None
+
+        self.headers = {"Accept-Encoding" : "gzip, deflate"}
         self.data = None
 
     def add_header(self, header, value):
@@ -75,23 +253,85 @@ class ExtendedHTTPConnection:
         else:
             url = path
 
-        
-        return self.conn.request(method, url, self.data, self.headers)
+        if self.conn is None:
+            self.conn, self.reused = self.pool.get(self.key,
+                                                   self.new_connection)
+        else:
+            self.finish_response()
+
+        self.last_request = (method, url, self.data, dict(self.headers))
+        self.response = None
+
+        try:
+            return self.conn.request(*self.last_request)
+        except socket.error:
+            if not self.reused:
+                raise
+            # The kept-alive socket was closed by the server
+            self.reconnect()
+            return self.conn.request(*self.last_request)
 
     def getresponse(self, *args):
-        return self.conn.getresponse(*args)
+        try:
+            self.response = self.conn.getresponse(*args)
+        except (socket.error, httplib.BadStatusLine):
+            if not self.reused:
+                raise
+            # The server closed the kept-alive socket before answering
+            self.reconnect()
+            self.conn.request(*self.last_request)
+            self.response = self.conn.getresponse(*args)
+
+        # From now on, the connection is known to work. If it breaks
+        # before the next request, it is because it was idle for too long.
+        self.reused = True
+        return DecodedResponse(self.response, self.host)
+
+    def reconnect(self):
+        STATS.incr("http", "connections_reconnected")
+        self.conn.close()
+        self.conn = self.new_connection()
+        self.reused = False
+
+    def finish_response(self):
+        """
+        Reads what remains of the last response so that the connection
+        can be used again.
+        """
+        if self.response is not None and not self.response.isclosed():
+            try:
+                self.response.read()
+            except (socket.error, httplib.HTTPException):
+                self.conn.close()
 
     def close(self):
-        return self.conn.close()
+        """
+        Gives the connection back to the pool.
+        """
+        if self.conn is None:
+            return
+
+        self.finish_response()
+        self.pool.put(self.key, self.conn)
+        self.conn = None
+        self.response = None
 
     def add_data(self, data):
         self.data = data
 
+    def new_connection(self):
+        if self.proxy_enabled:
+            return self.get_proxy_connection()
+        elif self.https:
+            return httplib.HTTPSConnection(self.host, self.port)
+        else:
+            return httplib.HTTPConnection(self.host, self.port)
+
     def get_proxy_connection(self):
         """
         Sets proxy if needed.
         """
-        http_proxy = os.environ["http_proxy"]
+        http_proxy = self.proxy
         http_proxy = http_proxy.replace("http://", "").rstrip("/")
         (proxy_host, proxy_port) = http_proxy.split(":")
         proxy_port = int(proxy_port)
@@ -106,4 +346,4 @@ class ExtendedHTTPConnection:
         httpbasicauth = "%s:%s" % (username, password)
         self.add_header("Authorization",
                    "Basic %s" % base64.encodestring(httpbasicauth).strip())
-                   
\ No newline at end of file
+                   
@@ -19,25 +19,42 @@
 
 import logging
 import os, os.path
-from config import CONFIG
 
-conf_dir = os.path.join(os.environ['HOME'], '.wikipediafs')
-file = os.path.join(conf_dir, 'wikipediafs.log')
+class LogFileHandler(logging.FileHandler):
+    """
+    Writes to ~/.wikipediafs/wikipediafs.log, which is only opened (and
+    its directory created if needed) when the first message is logged.
+    """
 
-# Creates .wikipediafs. in HOME if needed
-if not os.path.exists(conf_dir):
-    os.mkdir(conf_dir,0700)
+    def __init__(self):
+        self.conf_dir = os.path.join(os.environ['HOME'], '.wikipediafs')
+        logging.FileHandler.__init__(self,
+                                     os.path.join(self.conf_dir,
+                                                  'wikipediafs.log'),
+                                     delay=True)
+
+    def _open(self):
+        # Creates .wikipediafs. in HOME if needed
+        if not os.path.exists(self.conf_dir):
+            os.mkdir(self.conf_dir,0700)
+        return logging.FileHandler._open(self)
 
 LOGGER = logging.getLogger('wikipediafs')
-hdlr = logging.FileHandler(file)
+hdlr = LogFileHandler()
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 hdlr.setFormatter(formatter)
 LOGGER.addHandler(hdlr)
+LOGGER.setLevel(logging.INFO)
 
-if CONFIG.debug_mode:
-    LOGGER.setLevel(logging.DEBUG)
-else:
-    LOGGER.setLevel(logging.INFO)
+def set_debug(debug):
+    """
+    Logs the debug messages too if debug is true (see the debug option of
+    the configuration).
+    """
+    if debug:
+        LOGGER.setLevel(logging.DEBUG)
+    else:
+        LOGGER.setLevel(logging.INFO)
 
 # LOGGER.debug('A debug message')
 # LOGGER.info('Some information')
@@ -17,16 +17,96 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os, stat, errno, time
-from cStringIO import StringIO
+import os, stat, errno, time, threading
 import fuse
 from fuse import Fuse
 from logger import LOGGER
+from stats import STATS
+from buffer import SpillBuffer
+from hashlib import sha1
 
 # This setting is optional, but it ensures that this class will keep
 # working after a future API revision
 fuse.fuse_python_api = (0, 2)        
 
+class FileHandle:
+    """
+    State of one opened file, returned by open and create and passed back
+    by fuse to read, write, flush and release.
+    Each handle of a valid file has its own buffer, so that a reader never
+    uploads anything and a writer only uploads what it wrote.
+    Editor files share the buffer kept in MetaDir.files instead.
+    """
+    def __init__(self, path, flags, buf=None, lock=None, revid=None):
+        self.path = path
+        self.flags = flags
+        if buf is None:
+            buf = SpillBuffer()
+        self.buf = buf
+        if lock is None:
+            lock = threading.RLock()
+        self.lock = lock
+        # Revision the buffer was read from
+        self.revid = revid
+        # True when the buffer has been written to since it was last saved
+        self.dirty = False
+        # True once the buffer has been written to at all
+        self.written = False
+        # Hash of the content as it is known to be on the server
+        self.saved_hash = None
+        # Hash of the content which could not be saved
+        self.failed_hash = None
+        # Read by fuse-python when the handle is returned by open: the
+        # kernel then keeps the pages it read from the file before
+        self.keep_cache = False
+
+    def read(self, size, offset):
+        self.lock.acquire()
+        try:
+            return self.buf.read(size, offset)
+        finally:
+            self.lock.release()
+
+    def write(self, txt, offset):
+        self.lock.acquire()
+        try:
+            self.buf.write(txt, offset)
+            self.dirty = True
+            self.written = True
+        finally:
+            self.lock.release()
+        return len(txt)
+
+    def truncate(self, size):
+        self.lock.acquire()
+        try:
+            self.buf.truncate(size)
+            self.dirty = True
+            self.written = True
+        finally:
+            self.lock.release()
+
+    def getvalue(self):
+        self.lock.acquire()
+        try:
+            return self.buf.getvalue()
+        finally:
+            self.lock.release()
+
+    def hash(self):
+        self.lock.acquire()
+        try:
+            return self.buf.hash()
+        finally:
+            self.lock.release()
+
+    def size(self):
+        self.lock.acquire()
+        try:
+            return self.buf.size()
+        finally:
+            self.lock.release()
+
 class MetaDir(Fuse):
     """
     MetaDir allows to associate one directory with one class.
@@ -48,22 +128,41 @@ class MetaDir(Fuse):
             self.st_mtime = 0
             self.st_ctime = 0
 
-    READ = 0
-    WRITE = 1     
+    # Paths kept in the index of get_dir at most
+    DIR_INDEX_SIZE = 65536
 
     def __init__(self, *arr, **dic):
         Fuse.__init__(self, *arr, **dic)        
         self.dirs = {}
-        self.open_mode = None
+        # path -> directory object, as returned by get_dir
+        self.dir_index = {}
 
         # hold files used by the filesystem
         # valid files should be removed from it as soon as they are "released"
         # editor files should be kept
-        # (they will be deleted by the editors with unlink)
+        # (they will be deleted by the editors with unlink, or forgotten
+        # editor_file_time seconds after they were last used)
         self.files = {}
+        # path -> time the editor file was last used
+        self.files_used = {}
+        self.editor_file_time = 3600
+        # Buffers bigger than this are kept in temporary files
+        self.spill_size = 1024 * 1024
+        # Protects self.files and the buffers in multithreaded mode
+        self.files_lock = threading.RLock()
+        # Opened handles, by path
+        self.handles = {}
+        # Valid files truncated while nobody had them opened
+        # (older kernels truncate before open)
+        self.truncated = {}
+        # path -> revision of the valid file when it was last opened, when
+        # the kernel may still have its pages
+        self.open_revisions = {}
 
     def set_dir(self, path, directory):
         self.dirs[path] = directory
+        # The paths below it may have been resolved to another directory
+        self.dir_index = {}
                            
     def set_root(self, directory):
         self.set_dir('/', directory)
@@ -71,6 +170,19 @@ class MetaDir(Fuse):
     def get_dir(self, path):
         # Selects fs object on which we will call is_file, is_directory,
         # contents, etc
+        # set_dir replaces the index: a path resolved meanwhile is stored
+        # in the old one
+        index = self.dir_index
+        d = index.get(path)
+        if d is None:
+            d = self.find_dir(path)
+            if len(index) >= self.DIR_INDEX_SIZE:
+                index.clear()
+            index[path] = d
+        return d
+
+    def find_dir(self, path):
+        # Same as get_dir, without the index
         dirname = os.path.dirname(path)
                 
         if path == '/' and not self.dirs.has_key('/'):
@@ -78,22 +190,83 @@ class MetaDir(Fuse):
         elif self.dirs.has_key(dirname):
             return self.dirs[dirname]            
         else:
-            return self.get_dir(dirname)
+            return self.find_dir(dirname)
+
+    def new_buf(self):
+        return SpillBuffer(self.spill_size)
 
     def get_file_buf(self, path):
-        if not self.files.has_key(path):           
-            self.files[path] = StringIO()
-        return self.files[path]
+        self.files_lock.acquire()
+        try:
+            self.expire_file_bufs()
+            if not self.files.has_key(path):           
+                self.files[path] = self.new_buf()
+            self.files_used[path] = time.time()
+            return self.files[path]
+        finally:
+            self.files_lock.release()
 
     def remove_file_buf(self, path):
-        if self.files.has_key(path):
-            self.files.pop(path)
+        self.files_lock.acquire()
+        try:
+            if self.files.has_key(path):
+                buf = self.files.pop(path)
+                self.files_used.pop(path)
+                if not self.handles.has_key(path):
+                    # Otherwise still readable until it is closed
+                    buf.close()
+        finally:
+            self.files_lock.release()
+
+    def expire_file_bufs(self):
+        # Forgets the editor files nobody has opened for editor_file_time
+        # seconds (editors which crashed do not remove them)
+        self.files_lock.acquire()
+        try:
+            limit = time.time() - self.editor_file_time
+            for path, used in self.files_used.items():
+                if used < limit and not self.handles.has_key(path):
+                    LOGGER.debug("Forgetting editor file %s" % path)
+                    self.remove_file_buf(path)
+                    STATS.incr("files", "editor_files_expired")
+        finally:
+            self.files_lock.release()
+
+    def add_handle(self, handle):
+        self.files_lock.acquire()
+        try:
+            self.handles.setdefault(handle.path, []).append(handle)
+        finally:
+            self.files_lock.release()
+
+    def remove_handle(self, handle):
+        self.files_lock.acquire()
+        try:
+            handles = self.handles.get(handle.path, [])
+            if handles.count(handle) == 1:
+                handles.remove(handle)
+            if len(handles) == 0 and self.handles.has_key(handle.path):
+                self.handles.pop(handle.path)
+        finally:
+            self.files_lock.release()
+
+    def get_handle(self, path, dirty=False):
+        # Returns the last opened handle of path (or the last modified one)
+        self.files_lock.acquire()
+        try:
+            for handle in reversed(self.handles.get(path, [])):
+                if handle.dirty or not dirty:
+                    return handle
+            return None
+        finally:
+            self.files_lock.release()
 
     def has_file_buf(self, path):
-        if self.files.has_key(path):
-            return True
-        else:
-            return False                    
+        self.files_lock.acquire()
+        try:
+            return self.files.has_key(path)
+        finally:
+            self.files_lock.release()
 
     def is_valid_file(self, path):
         name = os.path.basename(path)
@@ -119,10 +292,18 @@ class MetaDir(Fuse):
         d = self.get_dir(path)
         st = MetaDir.Stat()
 
-        if self.files.has_key(path):
+        # Editor files may be created, renamed or removed meanwhile
+        self.files_lock.acquire()
+        try:
+            buf = self.files.get(path)
+            if buf is not None:
+                st.st_size = buf.size()
+        finally:
+            self.files_lock.release()
+
+        if buf is not None:
             st.st_mode = stat.S_IFREG | 0666
             st.st_nlink = 1
-            st.st_size = 0
         elif not self.is_valid_file(path):
             return -errno.ENOENT # No such file or directory
         elif d.is_directory(path):           
@@ -133,6 +314,15 @@ class MetaDir(Fuse):
             st.st_nlink = 1
             st.st_size = d.size(path)
             st.st_mtime = d.mtime(path)
+            handle = self.get_handle(path, dirty=True)
+            if handle is not None:
+                # Not saved yet
+                st.st_size = handle.size()
+        elif self.get_handle(path) is not None:
+            # Created but not saved yet
+            st.st_mode = stat.S_IFREG | 0666
+            st.st_nlink = 1
+            st.st_size = self.get_handle(path).size()
         else:
             return -errno.ENOENT # No such file or directory
         return st
@@ -145,25 +335,27 @@ class MetaDir(Fuse):
         else:
             d = self.get_dir(path + "/")            
 
+        # contents may return a generator, so that a large directory is
+        # listed while it is read
         dirs = d.contents(path)
 
         if dirs is None:
             dirs = []
 
         for e in ('.', '..'):
-            if dirs.count(e) == 0:
-                dirs.append(e)
+            yield fuse.Direntry(e)
                         
         for r in dirs:
-            yield fuse.Direntry(r)
+            if r != '.' and r != '..':
+                yield fuse.Direntry(r)
 
     def mknod(self, path, mode, dev):
         # Creates a filesystem node
         LOGGER.debug("mknod %s %d %s" % (path, mode, dev))
 
-    def create(self, path, mode, dev):
+    def create(self, path, flags, mode):
         # create is called to write a file that does not exist yet
-        LOGGER.debug("create %s %d %d" % (path, mode, dev))
+        LOGGER.debug("create %s %d %d" % (path, flags, mode))
 
         if self.is_valid_file(path):
             d = self.get_dir(path)
@@ -172,96 +364,255 @@ class MetaDir(Fuse):
                 return -errno.EACCES # Permission denied
         else:
             return -errno.EACCES # Permission denied
-        
-        self.get_file_buf(path)
-        
+
+        if dir(d).count("created") == 1:
+            d.created(path)
+
+        handle = FileHandle(path, flags, self.new_buf())
+        self.add_handle(handle)
+        return handle
 
     def truncate(self, path, size):
-        # Truncate is called just before open when a file is to be written
-        # in order to make it empty
+        # Truncate is called either on an opened file (ftruncate is then
+        # preferred) or, with older kernels, just before open when a file is
+        # to be written in order to make it empty
         LOGGER.debug("truncate %s %d" % (path, size))
 
-        buf = self.get_file_buf(path)
-        
-        if self.is_valid_file(path):
-            d = self.get_dir(path)           
-            txt = d.read_file(path)
-            buf.write(txt)
-            
-        buf.truncate(size)
+        if not self.is_valid_file(path):
+            handle = FileHandle(path, 0, self.get_file_buf(path),
+                                self.files_lock)
+            handle.truncate(size)
+            return None
+
+        self.files_lock.acquire()
+        try:
+            handles = self.handles.get(path, [])[:]
+        finally:
+            self.files_lock.release()
+        if len(handles) == 0:
+            # Kept for the next open
+            handle = FileHandle(path, 0, self.new_buf())
+            handle.write(self.get_dir(path).read_file(path), 0)
+            handle.truncate(size)
+            self.files_lock.acquire()
+            try:
+                self.truncated[path] = handle.buf
+            finally:
+                self.files_lock.release()
+
+        for handle in handles:
+            handle.truncate(size)
+
+    def ftruncate(self, path, size, fh=None):
+        LOGGER.debug("ftruncate %s %d" % (path, size))
+        if fh is None:
+            return self.truncate(path, size)
+        fh.truncate(size)
 
     def open(self, path, flags):
         LOGGER.debug("open %s %d" % (path, flags))
 
-        if not self.files.has_key(path):
-            if self.is_valid_file(path):
-                buf = self.get_file_buf(path)
-                d = self.get_dir(path)
-                txt = d.read_file(path)
-                buf.write(txt)
+        if not self.is_valid_file(path):
+            # Editor files are kept between opens
+            handle = FileHandle(path, flags, self.get_file_buf(path),
+                                self.files_lock)
+            if flags & os.O_TRUNC:
+                handle.truncate(0)
+            self.add_handle(handle)
+            return handle
 
-    def read(self, path, size, offset):
+        d = self.get_dir(path)
+        handle = FileHandle(path, flags, self.new_buf())
+
+        # Allows the directory to keep opened files in memory. Pinned
+        # before the file is read, so that what is read cannot be dropped
+        # (and got again by someone else) in the meantime
+        pinned = dir(d).count("pin") == 1
+        if pinned:
+            d.pin(path)
+
+        try:
+            self.files_lock.acquire()
+            try:
+                buf = self.truncated.pop(path, None)
+            finally:
+                self.files_lock.release()
+
+            if buf is not None:
+                handle.buf = buf
+                handle.dirty = handle.written = True
+            elif flags & os.O_TRUNC:
+                handle.dirty = handle.written = True
+            else:
+                handle.write(d.read_file(path), 0)
+                handle.dirty = handle.written = False
+                handle.saved_hash = handle.hash()
+
+            if dir(d).count("revision") == 1:
+                handle.revid = d.revision(path)
+            handle.keep_cache = self.keep_cache(path, handle)
+        except:
+            if pinned and dir(d).count("unpin") == 1:
+                d.unpin(path)
+            handle.buf.close()
+            raise
+
+        self.add_handle(handle)
+        return handle
+
+    def keep_cache(self, path, handle):
+        # The pages read by the kernel are still good if the file is opened
+        # again in the same revision. Otherwise (or when the revision is
+        # not known) not keeping them makes the kernel forget them.
+        d = self.get_dir(path)
+        keep = not handle.written and handle.revid is not None and \
+               (dir(d).count("kernel_cache") == 0 or d.kernel_cache(path))
+        self.files_lock.acquire()
+        try:
+            if not keep:
+                self.open_revisions.pop(path, None)
+                return False
+            if len(self.open_revisions) >= self.DIR_INDEX_SIZE:
+                self.open_revisions.clear()
+            keep = self.open_revisions.get(path) == handle.revid
+            self.open_revisions[path] = handle.revid
+            return keep
+        finally:
+            self.files_lock.release()
+
+    def read(self, path, size, offset, fh=None):
         LOGGER.debug("read %s %d %d" % (path, size, offset))
 
-        self.open_mode = self.READ
-
-        buf = self.get_file_buf(path)
+        if fh is None:
+            fh = self.get_handle(path)
+            if fh is None:
+                return -errno.EBADF # Bad file descriptor
 
-        buf.seek(offset)
-        return buf.read(size)
+        return fh.read(size, offset)
 
-    def write(self, path, txt, offset):
+    def write(self, path, txt, offset, fh=None):
         LOGGER.debug("write %s [...] %d" % (path, offset))
 
-        self.open_mode = self.WRITE
+        if fh is None:
+            fh = self.get_handle(path)
+            if fh is None:
+                return -errno.EBADF # Bad file descriptor
 
-        buf = self.get_file_buf(path)
+        return fh.write(txt, offset)
 
-        buf.seek(offset)
-        buf.write(txt)
-        return len(txt)
-
-
-    def fsync(self, path, isfsyncfile = 0):
+    def fsync(self, path, isfsyncfile = 0, fh=None):
         LOGGER.info("Fsync %s %s" % (path, isfsyncfile))
-        return self.flush (path, 0)
+        return self.flush(path, fh)
+
+    def save(self, path, fh):
+        # Uploads the handle buffer if its content was modified since it was
+        # read or last saved, so that each version is uploaded once however
+        # many times flush, fsync and release are called.
+        # Returns a negative errno on error.
+        if not self.is_valid_file(path):
+            return None
+
+        fh.lock.acquire()
+        try:
+            if not fh.dirty:
+                if fh.written:
+                    STATS.incr("files", "uploads_suppressed")
+                return None
 
-    def flush(self, path, flags = 0):
-        # Did we succeed?
-        success = True
+            txt = fh.getvalue()
+            txt_hash = sha1(txt).hexdigest()
+            if txt_hash == fh.saved_hash:
+                fh.dirty = False
+                STATS.incr("files", "uploads_suppressed")
+                return None
+
+            d = self.get_dir(path)
+            error = self.write_error(self.write_to(d, path, txt))
+            LOGGER.debug("save: error: %s\n" % (error));
+            STATS.incr("files", "uploads")
+            if error is not None:
+                STATS.incr("files", "uploads_failed")
+                fh.failed_hash = txt_hash
+                return error
+
+            fh.dirty = False
+            fh.saved_hash = txt_hash
+            if dir(d).count("revision") == 1:
+                fh.revid = d.revision(path)
+            return None
+        finally:
+            fh.lock.release()
+
+    def write_to(self, d, path, txt):
+        # Writes txt to path through its directory d. Once written, the
+        # pages the kernel has of the file are not what it contains.
+        ret = d.write_to(path, txt)
+        if self.write_error(ret) is None:
+            self.forget_revision(path)
+        return ret
+
+    def forget_revision(self, path):
+        # Makes the next open of path drop the pages of the kernel
+        self.files_lock.acquire()
+        try:
+            self.open_revisions.pop(path, None)
+        finally:
+            self.files_lock.release()
+
+    def write_error(self, ret):
+        # write_to returns True, False (I/O error) or a negative errno
+        if ret is False:
+            return -errno.EIO
+        elif type(ret) == int and ret < 0:
+            return ret
+        return None
 
+    def flush(self, path, fh=None):
         # Called to close the file
-        LOGGER.debug("flush %s %x" % (path, flags))        
+        LOGGER.debug("flush %s" % path)
 
-        if self.open_mode == self.WRITE and self.is_valid_file(path):
-            # for valid files
-            buf = self.get_file_buf(path)
-            d = self.get_dir(path)
-            success = d.write_to(path, buf.getvalue())
-            LOGGER.debug("flush: success: %d\n" % (success));
-            if success == False:
-                LOGGER.debug("flush: Returning\n" % (-errno.EIO));
-                return -errno.EIO
+        if fh is None:
+            fh = self.get_handle(path, dirty=True)
+            if fh is None:
+                return None
+
+        error = self.save(path, fh)
+        if error is not None:
+            LOGGER.debug("flush: Returning %d\n" % error);
+            return error
 
         return None
 
-    def release(self, path, flags):
+    def release(self, path, flags, fh=None):
         # Called to close the file
         LOGGER.debug("release %s %x" % (path, flags))        
 
-        # Release can not return errors, but try anyhow because we have no other choices.
-        # XXX: Is the flush called reliably enough to do this there?
-        if self.open_mode == self.WRITE and self.is_valid_file(path):
-            # for valid files
-            buf = self.get_file_buf(path)
-            d = self.get_dir(path)
-            success = d.write_to(path, buf.getvalue())
-            LOGGER.debug("release: success: %d\n" % (success));
+        if fh is None:
+            fh = self.get_handle(path)
+            if fh is None:
+                return None
 
-        if self.is_valid_file(path):
-            self.remove_file_buf(path) # Do not keep buffer in memory...
+        # Release can not return errors, but try anyhow in case flush was
+        # not called (the same content is not sent again if flush failed)
+        if fh.failed_hash is None or fh.hash() != fh.failed_hash:
+            self.save(path, fh)
+        self.remove_handle(fh)
 
-        self.open_mode = None
+        if self.is_valid_file(path):
+            if fh.written:
+                # The pages of the kernel may not be what was saved
+                self.forget_revision(path)
+            fh.buf.close()
+            d = self.get_dir(path)
+            if dir(d).count("unpin") == 1:
+                d.unpin(path)
+        else:
+            self.files_lock.acquire()
+            try:
+                if self.files.has_key(path):
+                    self.files_used[path] = time.time()
+            finally:
+                self.files_lock.release()
 
         return None
 
@@ -311,7 +662,12 @@ class MetaDir(Fuse):
             if not self.is_valid_file(path1):
                 # from a valid file to an editor file               
                 buf = self.get_file_buf(path1)
-                buf.write(d.read_file(path))
+                self.files_lock.acquire()
+                try:
+                    buf.truncate(0)
+                    buf.write(d.read_file(path), 0)
+                finally:
+                    self.files_lock.release()
                 # TODO : remove path ?
             else:
                 # from a valid file to a valid file
@@ -322,11 +678,9 @@ class MetaDir(Fuse):
             if self.is_valid_file(path1) and d.is_file(path1):
                 # from an editor file to a valid file
                 buf = self.get_file_buf(path)
-                ret = d.write_to(path1, buf.getvalue())
-                self.open_mode = None
+                ret = self.write_to(d, path1, buf.getvalue())
                 self.remove_file_buf(path)
-                if ret == False:
-                    return -errno.EIO
+                return self.write_error(ret)
             elif not self.is_valid_file(path):
                 # from an editor file to an editor file
                 # TODO
@@ -382,6 +736,9 @@ if __name__ == "__main__":
         def mode(self, path):
             return 0755
 
+        def mtime(self, path):
+            return 0
+
         def read_file(self, path):
             if path == '/hello_file':
                 return self.hello_file_content
@@ -402,17 +759,52 @@ if __name__ == "__main__":
     print fs.readdir('/', 0)
     print fs.getattr('/hello_file')
 
-    fs.open('/hello_file', 32768)    
-    print fs.read('/hello_file', 100, 0)
-    fs.release('/hello_file', 32768)
+    fh = fs.open('/hello_file', 32768)
+    print fs.read('/hello_file', 100, 0, fh)
+    fs.release('/hello_file', 32768, fh)
 
-    fs.open('/hello_file', 32768)    
-    fs.write('/hello_file', 'New string', 0)
-    fs.release('/hello_file', 32768)
+    fh = fs.open('/hello_file', 32768)
+    fs.write('/hello_file', 'New string', 0, fh)
+    fs.release('/hello_file', 32768, fh)
 
-    fs.open('/hello_file', 32768)
-    print fs.read('/hello_file', 100, 0)
-    fs.release('/hello_file', 32768)
+    fh = fs.open('/hello_file', 32768)
+    print fs.read('/hello_file', 100, 0, fh)
+    fs.release('/hello_file', 32768, fh)
 
     print fs.mkdir('/new_dir', 32768)
     
+
+    # Benchmark of getattr on files deep in a hierarchy of subpages: each
+    # level of /sub is a directory of its own (as after ArticleDir.mkdir)
+    # while only the first level of /deep is, so that find_dir has to go
+    # up to it
+    import timeit
+
+    class Level(Hello):
+        def is_directory(self, path):
+            return ["sub", "deep"].count(os.path.basename(path)) == 1
+
+        def is_file(self, path):
+            return os.path.basename(path) == "page"
+
+    fs = TestFS()
+    dirname = ""
+    for depth in range(1, 51):
+        dirname += "/sub"
+        fs.set_dir(dirname, Level())
+    fs.set_dir("/deep", Level())
+
+    print
+    print "%-5s %5s %12s %12s %12s" % ("tree", "depth", "find_dir/s",
+                                       "get_dir/s", "getattr/s")
+    for tree in ("sub", "deep"):
+        for depth in (1, 5, 20, 50):
+            path = ("/" + tree) * depth + "/page"
+            assert fs.get_dir(path) is fs.find_dir(path)
+            rates = []
+            for func in (fs.find_dir, fs.get_dir, fs.getattr):
+                n = 20000
+                t = min(timeit.repeat(lambda: func(path), number=n,
+                                      repeat=3))
+                rates.append(n / t)
+            print "%-5s %5d %12d %12d %12d" % ((tree, depth) + tuple(rates))
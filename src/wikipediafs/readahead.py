@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import re, threading
+from collections import OrderedDict
+from stats import STATS
+from logger import LOGGER
+
+# [[Target]], [[Target|label]], [[Target#section]]
+LINK = re.compile(r"\[\[([^\[\]\{\}\|#<>\n]+)")
+# {{Name}}, {{Name|parameters}}
+TEMPLATE = re.compile(r"\{\{([^\[\]\{\}\|#<>\n]+)")
+
+def normalize(title):
+    """
+    " some title " -> "Some_title", as Mediawiki does.
+    """
+    title = title.strip().replace(" ", "_")
+    try:
+        title = title.decode("utf-8")
+    except UnicodeError:
+        return title
+    return (title[0:1].upper() + title[1:]).encode("utf-8")
+
+def extract_links(content, title, limit):
+    """
+    Returns the titles of the limit articles and templates content links
+    to the most, most linked first. Links to the other namespaces,
+    including categories and files, and to other sites are left out.
+    """
+    # title -> [count, position]
+    found = {}
+
+    def add(target):
+        target = normalize(target)
+        if target and target != title:
+            entry = found.setdefault(target, [0, len(found)])
+            entry[0] += 1
+
+    for target in LINK.findall(content):
+        target = target.strip()
+        if target.startswith("/"):
+            # Subpage
+            add(title + target.rstrip("/"))
+        elif target.startswith("../"):
+            continue
+        elif target.find(":") == -1 or \
+             target.split(":", 1)[0].find(" ") != -1:
+            # "Star Wars: Episode I" is not in a namespace
+            add(target)
+
+    for target in TEMPLATE.findall(content):
+        target = target.strip()
+        if target.startswith(":"):
+            # Article of the main namespace used as a template
+            add(target[1:])
+        elif target.find(":") == -1 and target.upper() != target:
+            # Magic words such as {{PAGENAME}} are upper case
+            add("Template:" + target)
+
+    titles = found.keys()
+    titles.sort(lambda a, b: cmp(found[b][0], found[a][0]) or
+                             cmp(found[a][1], found[b][1]))
+    return titles[:limit]
+
+class ReadAhead:
+    """
+    Gets in the background the articles an article links to, so that they
+    are in the caches when they are opened.
+    fetched is called with the content of each article got from the site:
+    the limit most linked articles and templates which exist (asked with
+    one request) and are not cached yet are then got by threads threads,
+    and so on for the articles they link to, up to depth links away.
+    Nothing is got while an article is being got for a file system
+    request (see foreground).
+    """
+
+    # Articles waiting to be got at most, the oldest are forgotten
+    MAX_QUEUE = 200
+    # Articles got ahead and not used yet which are remembered
+    MAX_FETCHED = 5000
+
+    def __init__(self, site, limit=10, threads=2, depth=1):
+        self.site = site
+        self.limit = limit
+        self.threads = threads
+        self.depth = depth
+        self.cond = threading.Condition()
+        # Tasks, first done first: ("links", title, content, depth) and
+        # ("fetch", title, depth)
+        self.queue = []
+        # title -> True for the fetch tasks in queue
+        self.queued = {}
+        # title -> True for the articles got ahead and not used yet
+        self.fetched_ahead = OrderedDict()
+        # Articles being got for file system requests
+        self.active = 0
+        self.started = False
+
+    def start(self):
+        self.started = True
+        for i in range(self.threads):
+            thread = threading.Thread(target=self.__run)
+            thread.setDaemon(True)
+            thread.start()
+
+    def foreground(self, delta):
+        """
+        Called with 1 and -1 around each article got for a file system
+        request.
+        """
+        self.cond.acquire()
+        try:
+            self.active += delta
+            if self.active == 0:
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def fetched(self, title, content, depth=0):
+        """
+        Called when the content of title has been got from the site, depth
+        links away from an article opened by the user.
+        """
+        if depth >= self.depth:
+            return
+        self.cond.acquire()
+        try:
+            if not self.started:
+                # Not before: threads started before the file system is
+                # mounted do not survive the fork when fuse goes to
+                # background
+                self.start()
+            # The links of the last article first
+            self.queue.insert(0, ("links", title, content, depth + 1))
+            self.__trim()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def used(self, title):
+        """
+        Called when title is read from the caches for a file system
+        request.
+        """
+        self.cond.acquire()
+        try:
+            if not self.fetched_ahead.has_key(title):
+                return
+            self.fetched_ahead.pop(title)
+        finally:
+            self.cond.release()
+        STATS.incr(self.site.host, "read_ahead_hits")
+        self.__update_ratio()
+
+    def __update_ratio(self):
+        fetches = STATS.get(self.site.host, "read_ahead_fetches")
+        if fetches > 0:
+            hits = STATS.get(self.site.host, "read_ahead_hits")
+            STATS.set(self.site.host, "read_ahead_hit_ratio",
+                      100 * hits / fetches)
+
+    def __trim(self):
+        # Must be called with the lock held
+        while len(self.queue) > self.MAX_QUEUE:
+            task = self.queue.pop()
+            if task[0] == "fetch":
+                self.queued.pop(task[1])
+
+    def __next(self):
+        self.cond.acquire()
+        try:
+            while len(self.queue) == 0 or self.active > 0:
+                self.cond.wait()
+            task = self.queue.pop(0)
+            if task[0] == "fetch":
+                self.queued.pop(task[1])
+            return task
+        finally:
+            self.cond.release()
+
+    def __run(self):
+        while True:
+            task = self.__next()
+            try:
+                if task[0] == "links":
+                    self.__links(*task[1:])
+                else:
+                    self.__fetch(*task[1:])
+            except Exception, e:
+                LOGGER.debug("Read-ahead of %s failed: %s" % (task[1], e))
+
+    def __links(self, title, content, depth):
+        titles = []
+        for target in extract_links(content, title, self.limit):
+            art = self.site.articles.peek(target)
+            if art is None or art.expired():
+                titles.append(target)
+
+        # Articles which do not exist are not got
+        self.site.prefetch(titles)
+        tasks = []
+        for target in titles:
+            if not self.site.missing.get(target):
+                tasks.append(("fetch", target, depth))
+
+        self.cond.acquire()
+        try:
+            tasks = [t for t in tasks if not self.queued.has_key(t[1])]
+            for task in tasks:
+                self.queued[task[1]] = True
+            # After the links of the other articles got ahead, which are
+            # before them
+            i = 0
+            while i < len(self.queue) and self.queue[i][0] == "links":
+                i += 1
+            self.queue[i:i] = tasks
+            self.__trim()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def __fetch(self, title, depth):
+        content = self.site.fetch_ahead(title)
+        if content is None:
+            return # already cached
+        STATS.incr(self.site.host, "read_ahead_fetches")
+        self.cond.acquire()
+        try:
+            self.fetched_ahead[title] = True
+            while len(self.fetched_ahead) > self.MAX_FETCHED:
+                self.fetched_ahead.popitem(False)
+        finally:
+            self.cond.release()
+        self.__update_ratio()
+        self.fetched(title, content, depth)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, time, threading, tempfile
+from user import User
+from hashlib import sha1
+
+class Session:
+    """
+    Login session of a site, shared by all its directories and articles.
+    The cookies are kept in a file of directory with their expiry time, so
+    that the next mount does not have to log in again. Cookies sent without
+    an expiry time are kept lifetime seconds.
+    The user logs in again only when the cookies have expired or when the
+    server reports that the session has expired (see expired).
+    """
+
+    MAGIC = "WFS-SESSION-1"
+
+    def __init__(self, config, directory=None, lifetime=7200, logger=None):
+        self.config = config
+        self.directory = directory
+        self.lifetime = lifetime
+        self.logger = logger
+
+        # Only one login at a time
+        self.lock = threading.Lock()
+        # Cookie string given in the configuration, if any
+        self.cookie_str = config.get("cookie_str")
+        self.expires = None
+        self.login_time = 0
+        self.loaded = False
+
+    def can_login(self):
+        return self.config.get("username") is not None and \
+               self.config.get("password") is not None
+
+    def __file_name(self):
+        key = "%s %s %s %s" % (self.config["host"], self.config.get("port"),
+                               self.config["basename"],
+                               self.config["username"])
+        return os.path.join(self.directory, sha1(key).hexdigest())
+
+    def __valid(self):
+        return self.cookie_str is not None and \
+               (self.expires is None or self.expires > time.time())
+
+    def get(self):
+        """
+        Returns the cookie string to send, logging in if needed.
+        """
+        if not self.can_login():
+            return self.cookie_str
+
+        self.lock.acquire()
+        try:
+            if not self.loaded:
+                self.loaded = True
+                self.__load()
+            if not self.__valid():
+                self.__login()
+            return self.cookie_str
+        finally:
+            self.lock.release()
+
+    def peek(self):
+        """
+        Returns the cookie string last got, without logging in.
+        """
+        return self.cookie_str
+
+    def expired(self, cookie_str):
+        """
+        Called when the server did not accept cookie_str: the next get will
+        log in again, unless another thread did it in the meantime.
+        """
+        if not self.can_login():
+            return
+
+        self.lock.acquire()
+        try:
+            if self.cookie_str == cookie_str:
+                if self.logger:
+                    self.logger.info("Session expired on %s" %
+                                     self.config["host"])
+                self.cookie_str = None
+                self.expires = None
+                self.__remove()
+        finally:
+            self.lock.release()
+
+    def __login(self):
+        # Must be called with the lock held
+        user = User(logger=self.logger, **self.config)
+        cookie_str = user.getCookieString()
+        self.login_time = time.time()
+        if cookie_str is None:
+            # Requests are sent anonymously until the next try
+            self.cookie_str = self.config.get("cookie_str")
+            self.expires = self.login_time + 60
+            return
+
+        self.cookie_str = cookie_str
+        self.expires = user.expires
+        if self.expires is None:
+            self.expires = self.login_time + self.lifetime
+        self.__save()
+
+    def __load(self):
+        # Must be called with the lock held
+        if self.directory is None:
+            return
+        try:
+            f = open(self.__file_name(), "rb")
+            try:
+                magic, expires, cookie_str = f.read().split("\n")[0:3]
+            finally:
+                f.close()
+            if magic != self.MAGIC:
+                raise ValueError
+            expires = float(expires)
+        except (IOError, OSError, ValueError):
+            return
+
+        if expires > time.time():
+            self.cookie_str = cookie_str
+            self.expires = expires
+            if self.logger:
+                self.logger.debug("Reusing the session of %s" %
+                                  self.config["host"])
+
+    def __save(self):
+        # Must be called with the lock held
+        if self.directory is None:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory, 0700)
+            # mkstemp creates files only readable by the user
+            fd, tmp = tempfile.mkstemp(prefix=".", dir=self.directory)
+            try:
+                os.write(fd, "\n".join((self.MAGIC, repr(self.expires),
+                                        self.cookie_str, "")))
+            finally:
+                os.close(fd)
+            os.rename(tmp, self.__file_name())
+        except (IOError, OSError), e:
+            if self.logger:
+                self.logger.error("Cannot save the session: %s" % e)
+
+    def __remove(self):
+        # Must be called with the lock held
+        if self.directory is None:
+            return
+        try:
+            os.remove(self.__file_name())
+        except OSError:
+            pass
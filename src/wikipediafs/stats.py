@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+
+class Stats:
+    """
+    Thread-safe counters, grouped by name (e.g. "http" or a site host).
+    They are only meant to check that caches and pools do their job.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}
+
+    def incr(self, group, counter, value=1):
+        self.lock.acquire()
+        try:
+            counters = self.groups.setdefault(group, {})
+            counters[counter] = counters.get(counter, 0) + value
+        finally:
+            self.lock.release()
+
+    def set(self, group, counter, value):
+        self.lock.acquire()
+        try:
+            self.groups.setdefault(group, {})[counter] = value
+        finally:
+            self.lock.release()
+
+    def get(self, group, counter=None):
+        self.lock.acquire()
+        try:
+            counters = self.groups.get(group, {})
+            if counter is None:
+                return dict(counters)
+            else:
+                return counters.get(counter, 0)
+        finally:
+            self.lock.release()
+
+    def dump(self):
+        """
+        Returns all the counters as text, one "[group]" section per group.
+        """
+        self.lock.acquire()
+        try:
+            lines = []
+            groups = self.groups.keys()
+            groups.sort()
+            for group in groups:
+                lines.append("[%s]" % group)
+                counters = self.groups[group].items()
+                counters.sort()
+                for k, v in counters:
+                    lines.append("%s %s" % (k, v))
+                lines.append("")
+            return "\n".join(lines)
+        finally:
+            self.lock.release()
+
+STATS = Stats()
+
+if __name__ == "__main__":
+    STATS.incr("http", "connections_new")
+    STATS.incr("http", "connections_reused", 3)
+    STATS.incr("fr.wikipedia.org", "bytes_received", 1024)
+    print STATS.dump()
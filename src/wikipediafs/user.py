@@ -17,7 +17,8 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import urllib, re
+import urllib, re, time
+from email.utils import parsedate_tz, mktime_tz
 from http import ExtendedHTTPConnection
 from logger import printlog
 
@@ -40,7 +41,15 @@ class User:
                  # Not actually needed, just here for compatibility
                  name=None,
                  cookie_str=None,
-                 dirname=None
+                 dirname=None,
+                 api=None,
+                 fetch_backend=None,
+                 memory_cache_size=None,
+                 recent_changes=None,
+                 read_ahead=None,
+                 read_ahead_threads=None,
+                 read_ahead_depth=None,
+                 kernel_cache=None
                  ):
 
         self.username = username
@@ -54,6 +63,9 @@ class User:
         self.httpauth_password = httpauth_password
         self.logger = logger
 
+        # Time the cookies expire, if they said so
+        self.expires = None
+
         # url pattern
         self.login_page = "%s?title=Special:Userlogin" % self.basename
         self.login_page += "&action=submit"
@@ -80,16 +92,17 @@ class User:
         conn.request(self.login_page)
         response = conn.getresponse()
 
-        printlog(self.logger, "debug", "URL: %s, response status: %d, text: %s" % (self.login_page, response.status, response.read()))
+        # The body can only be read once
+        body = response.read()
+        printlog(self.logger, "debug", "URL: %s, response status: %d, text: %s" % (self.login_page, response.status, body))
         while response.status == 301 or response.status == 302: # follow redirects; would be better to check for status 301 and 302
             printlog(self.logger, "debug", "Redirecting to %s due to status of %d." % (response.getheader("Location"), response.status))
-            response.read()
             conn.request(response.getheader("Location"))
             response = conn.getresponse()
+            body = response.read()
             printlog(self.logger, "debug", "Redirected: Status %d." % (response.status))
 
-        match = re.search('wpLoginToken"\s*value="(\w*)"',
-                                response.read())
+        match = re.search('wpLoginToken"\s*value="(\w*)"', body)
         printlog(self.logger, "debug", "Token Match: %s." % (match))
 
         if match:
@@ -132,6 +145,7 @@ class User:
 
             if it_matches:
                 cookie_list.append(it_matches.group(1))
+                self.__setExpires(cookie_value)
 
         conn.close()
 
@@ -146,9 +160,25 @@ class User:
             return "; ".join(cookie_list)
         else:
             printlog(self.logger, "warning",
-                     "Could not log in with username %s: %s" % self.username)
+                     "Could not log in with username %s" % self.username)
             return None
 
+    def __setExpires(self, cookie_value):
+        # Keeps the earliest expiry time of the cookies, ignoring the
+        # cookies which are deleted
+        expires = None
+        match = re.search('max-age=(\d+)', cookie_value, re.IGNORECASE)
+        if match:
+            expires = time.time() + int(match.group(1))
+        else:
+            match = re.search('expires=([^;]*)', cookie_value, re.IGNORECASE)
+            if match and parsedate_tz(match.group(1).strip()) is not None:
+                expires = mktime_tz(parsedate_tz(match.group(1).strip()))
+
+        if expires is not None and expires > time.time() and \
+           (self.expires is None or expires < self.expires):
+            self.expires = expires
+
 
 if __name__ == "__main__":
     import sys
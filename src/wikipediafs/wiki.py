@@ -0,0 +1,722 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time, threading
+from article import WikiClient, Article
+from backend import new_attrs, edittime_to_mtime, api_to_mtime
+from cache import AttrCache, DiskCache, MemoryCache
+from session import Session
+from readahead import ReadAhead
+from stats import STATS
+
+class Site(WikiClient):
+    """
+    State shared by all the directories of a site.
+    """
+
+    # Maximum number of titles per api.php query
+    BATCH_SIZE = 50
+
+    def __init__(self, config, cache_time=30, logger=None,
+                 cache_dir=None, cache_size=0, session_dir=None,
+                 login_time=7200, listing_time=300, missing_time=60):
+        # Shared with the articles of the site
+        session = Session(config, session_dir, login_time, logger)
+        WikiClient.__init__(self, logger=logger, session=session, **config)
+        self.config = config
+        self.cache_time = cache_time
+
+        self.attrs = AttrCache(cache_time)
+        # Titles known not to exist (title -> True), so that looking for
+        # them again costs no request
+        self.missing = AttrCache(missing_time)
+
+        # prefix (or ("members", category)) -> (time, titles) of the
+        # articles listed by list_pages (or list_members)
+        self.listing_time = listing_time
+        self.listings = {}
+        self.listings_lock = threading.Lock()
+
+        # Article objects by title
+        memory_size = int(config.get("memory_cache_size") or 0) * 1024 * 1024
+        self.articles = MemoryCache(memory_size, stats_group=self.host)
+
+        if cache_dir is not None and cache_size > 0:
+            self.disk_cache = DiskCache(cache_dir, cache_size)
+        else:
+            self.disk_cache = None
+
+        # In offline mode, articles are only read from the caches
+        self.offline = False
+
+        # Gets the articles linked to in the background
+        if config.get("read_ahead"):
+            self.read_ahead = ReadAhead(
+                self, int(config["read_ahead"]),
+                int(config.get("read_ahead_threads") or 2),
+                int(config.get("read_ahead_depth") or 1))
+        else:
+            self.read_ahead = None
+
+    def article(self, title):
+        """
+        Returns the Article object of title, created if needed.
+        """
+        art = self.articles.get(title)
+        if art is not None:
+            return art
+
+        self.articles.lock.acquire()
+        try:
+            # Another thread may have created it in the meantime
+            art = self.articles.peek(title)
+            if art is None:
+                art = Article(title, cache_time=self.cache_time,
+                              logger=self.logger, session=self.session,
+                              **self.config)
+                self.articles.set(title, art)
+        finally:
+            self.articles.lock.release()
+        return art
+
+    def stat(self, title):
+        """
+        Returns the attributes of an article (see backend.new_attrs) or
+        None if they cannot be known without getting the article.
+        """
+        if self.missing.get(title):
+            STATS.incr(self.host, "missing_hits")
+            return new_attrs(False)
+
+        attrs = self.attrs.get(title)
+        if attrs is not None:
+            STATS.incr(self.host, "attrs_hits")
+            return attrs
+
+        STATS.incr(self.host, "attrs_misses")
+        if self.offline:
+            return self.offline_stat(title)
+        return self.prefetch([title]).get(title)
+
+    def offline_stat(self, title):
+        # Attributes of the copy of an article kept in memory or on disk
+        art = self.articles.peek(title)
+        if art is not None and art.last_get > 0:
+            return new_attrs(len(art.content.strip()) > 0, len(art.content),
+                             edittime_to_mtime(art.wpEdittime), art.revid)
+
+        if self.disk_cache is not None:
+            entry = self.disk_cache.get(title)
+            if entry is not None:
+                return new_attrs(len(entry["content"].strip()) > 0,
+                                 len(entry["content"]),
+                                 edittime_to_mtime(entry["edittime"]),
+                                 entry["revid"])
+        return new_attrs(False)
+
+    def prefetch(self, titles):
+        """
+        Gets the attributes of the articles whose attributes are not
+        cached, with one request per BATCH_SIZE articles.
+        Returns the attributes which have been fetched.
+        """
+        if self.offline:
+            return {}
+
+        missing = []
+        for title in titles:
+            if self.attrs.get(title) is None and not self.missing.get(title):
+                missing.append(title)
+
+        fetched = {}
+        for i in range(0, len(missing), self.BATCH_SIZE):
+            result = self.backend.stat(self, missing[i:i + self.BATCH_SIZE])
+            if result is None:
+                break # not supported by the backend
+            STATS.incr(self.host, "attrs_requests")
+            for k, v in result.items():
+                if v["exists"]:
+                    self.attrs.set(k, v)
+                else:
+                    self.not_found(k)
+            fetched.update(result)
+        return fetched
+
+    def list_pages(self, prefix=""):
+        """
+        Generates the titles of the articles starting with prefix, one
+        batch of the backend at a time, and keeps their attributes.
+        The list is kept listing_time seconds.
+        Generates nothing if the backend cannot list articles.
+        """
+        return self.__list(prefix, self.backend.list_pages, prefix)
+
+    def list_members(self, category):
+        """
+        Same as list_pages for the members of a category
+        ("Category:Name").
+        """
+        return self.__list(("members", category), self.backend.list_members,
+                           category)
+
+    def has_members(self, category):
+        """
+        Tells whether a category has members, asking for one member at
+        most. Returns None if it cannot be known.
+        """
+        self.listings_lock.acquire()
+        try:
+            listing = self.listings.get(("members", category))
+        finally:
+            self.listings_lock.release()
+        if listing is not None and \
+           (self.offline or time.time() - listing[0] <= self.listing_time):
+            STATS.incr(self.host, "listing_hits")
+            return len(listing[1]) > 0
+        elif self.offline:
+            return None
+
+        result = self.backend.list_members(self, category, limit=1)
+        if result is None:
+            return None # not supported by the backend
+        STATS.incr(self.host, "listing_requests")
+        return len(result[0]) > 0
+
+    def __list(self, key, list_batch, arg):
+        self.listings_lock.acquire()
+        try:
+            listing = self.listings.get(key)
+        finally:
+            self.listings_lock.release()
+
+        if listing is not None and \
+           (self.offline or time.time() - listing[0] <= self.listing_time):
+            STATS.incr(self.host, "listing_hits")
+            for title in listing[1]:
+                yield title
+            return
+        elif self.offline:
+            return
+
+        STATS.incr(self.host, "listing_misses")
+        started = time.time()
+        titles = []
+        cont = None
+        while True:
+            result = list_batch(self, arg, cont)
+            if result is None:
+                return # not supported by the backend
+            STATS.incr(self.host, "listing_requests")
+            attrs, cont = result
+
+            batch = attrs.keys()
+            batch.sort()
+            for title in batch:
+                self.attrs.set(title, attrs[title])
+                self.missing.invalidate(title)
+            titles.extend(batch)
+            for title in batch:
+                yield title
+
+            if cont is None:
+                break
+
+        # Only complete lists are kept
+        self.listings_lock.acquire()
+        try:
+            self.listings[key] = (started, titles)
+        finally:
+            self.listings_lock.release()
+
+    def changed(self, change):
+        """
+        Updates the caches after a change made on the server (see
+        backend.ApiBackend.recent_changes): the copies of the article are
+        forgotten unless they are of the changed revision, its attributes
+        are refreshed and the lists it belongs to are dropped.
+        """
+        if change["type"] == "categorize":
+            # The members of the category changed
+            self.drop_listings(change["title"])
+            return
+
+        for title in (change["title"], change["target"]):
+            if title is None:
+                continue
+            self.missing.invalidate(title)
+            art = self.articles.peek(title)
+            if change["revid"] is None:
+                # Deleted, moved, protected...
+                self.attrs.invalidate(title)
+            elif art is not None or self.attrs.get(title) is not None:
+                self.attrs.set(title, new_attrs(
+                    True, change["size"], api_to_mtime(change["timestamp"]),
+                    change["revid"]))
+
+            if art is None or art.revid != change["revid"] or \
+               change["revid"] is None:
+                if art is not None:
+                    # forces the article to be got next time
+                    art.last_get = 0
+                    STATS.incr(self.host, "changes_invalidated")
+                if self.disk_cache is not None:
+                    self.disk_cache.remove(title)
+
+            if change["type"] != "edit":
+                self.drop_listings(title)
+
+    def drop_listings(self, title):
+        """
+        Forgets the lists title may belong to (or the list of the members
+        of title if it is a category).
+        """
+        self.listings_lock.acquire()
+        try:
+            for key in self.listings.keys():
+                if key == ("members", title) or \
+                   type(key) == str and title.startswith(key):
+                    self.listings.pop(key)
+        finally:
+            self.listings_lock.release()
+
+    def not_found(self, title):
+        """
+        Records that title does not exist. Its Article object is not kept,
+        unless the article is opened.
+        """
+        self.missing.set(title, True)
+        self.attrs.invalidate(title)
+        self.articles.discard(title)
+
+    def get_article(self, title, art):
+        """
+        Gets the content of an article. An expired article is not
+        downloaded again if the server still has the same revision.
+        """
+        if self.read_ahead is not None:
+            self.read_ahead.foreground(1)
+        art.lock.acquire()
+        try:
+            return self.__get_article(title, art)
+        finally:
+            art.lock.release()
+            if self.read_ahead is not None:
+                self.read_ahead.foreground(-1)
+
+    def fetch_ahead(self, title):
+        """
+        Gets title for the read-ahead. Returns its content, or None if it
+        was cached already.
+        """
+        if self.offline:
+            return None
+        art = self.article(title)
+        art.lock.acquire()
+        try:
+            if not art.expired():
+                return None
+            return self.__get_article(title, art, True)
+        finally:
+            art.lock.release()
+
+    def __get_article(self, title, art, ahead=False):
+        if self.offline:
+            return self.__get_offline(title, art)
+
+        if art.expired():
+            if art.revid is not None:
+                self.revalidate(title, art)
+            elif self.disk_cache is not None:
+                self.load_from_disk(title, art)
+
+        fetched = art.expired()
+        txt = art.get()
+        self.articles.update(title)
+        if fetched:
+            STATS.incr(self.host, "full_fetches")
+            self.article_fetched(title, art)
+            if self.disk_cache is not None and art.revid is not None:
+                self.disk_cache.set(title, art.content, art.revid,
+                                    art.wpEdittime)
+
+        if self.read_ahead is not None and not ahead:
+            if fetched:
+                self.read_ahead.fetched(title, txt)
+            else:
+                self.read_ahead.used(title)
+        return txt
+
+    def __get_offline(self, title, art):
+        # Whatever the age of the copy we have
+        if art.last_get == 0 and self.disk_cache is not None:
+            entry = self.disk_cache.get(title)
+            if entry is not None:
+                art.load(entry["content"], entry["revid"], entry["edittime"])
+                STATS.incr(self.host, "disk_cache_hits")
+            else:
+                STATS.incr(self.host, "disk_cache_misses")
+
+        art.is_empty = len(art.content.strip()) == 0
+        self.articles.update(title)
+        return art.content
+
+    def revalidate(self, title, art):
+        attrs = self.stat(title)
+        if attrs is not None and attrs["revid"] == art.revid:
+            art.load(art.content, art.revid, art.wpEdittime)
+            if self.disk_cache is not None:
+                self.disk_cache.validated(title)
+            STATS.incr(self.host, "revalidation_hits")
+        else:
+            STATS.incr(self.host, "revalidation_misses")
+
+    def load_from_disk(self, title, art):
+        entry = self.disk_cache.get(title)
+        if entry is not None and self.is_current(title, entry):
+            art.load(entry["content"], entry["revid"], entry["edittime"])
+            STATS.incr(self.host, "disk_cache_hits")
+        else:
+            STATS.incr(self.host, "disk_cache_misses")
+
+    def is_current(self, title, entry):
+        if time.time() - entry["validated"] <= self.cache_time:
+            return True
+
+        # Checks the revision known by the server
+        attrs = self.stat(title)
+        if attrs is not None and attrs["revid"] == entry["revid"]:
+            self.disk_cache.validated(title)
+            return True
+        else:
+            return False
+
+    def article_fetched(self, title, art):
+        """
+        Updates the attributes of an article from its content.
+        """
+        self.attrs.set(title, new_attrs(len(art.content.strip()) > 0,
+                                        len(art.content),
+                                        edittime_to_mtime(art.wpEdittime),
+                                        art.revid))
+
+    def article_saved(self, title, art):
+        # The revision of the saved article is not known
+        self.missing.invalidate(title)
+        art.revid = None
+        self.articles.update(title)
+        if self.disk_cache is not None:
+            self.disk_cache.remove(title)
+        self.attrs.set(title, new_attrs(len(art.content.strip()) > 0,
+                                        len(art.content),
+                                        time.time(),
+                                        None))
+
+if __name__ == "__main__":
+    # Stress test: several threads read and write the articles of a local
+    # mock wiki at the same time, directly and through MetaDir (if fuse is
+    # installed).
+    import BaseHTTPServer, SocketServer, urlparse, random, os, errno
+    from article import Article, EDIT_CONFLICT
+    from backend import json
+    from http import POOL
+
+    # title -> [text, revid]
+    pages = {}
+
+    def edittime(revid):
+        # Each revision has its own time, so that stale edits are refused
+        return time.gmtime(1178999703 + revid)
+
+    for i in range(20):
+        pages["Page%d" % i] = ["Page%d 0" % i, 1]
+    pages["Slow"] = ["slow", 1]
+    pages_lock = threading.Lock()
+
+    class MockWiki(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def answer(self, status, body, headers={}):
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path)[4]))
+            if query.get("meta") == "tokens":
+                result = {"query" : {"tokens" : {"csrftoken" : "+\\"}}}
+                return self.answer(200, json.dumps(result))
+
+            result = {}
+            pages_lock.acquire()
+            for title in query["titles"].split("|"):
+                text, revid = pages[title]
+                rev = {"revid" : revid, "size" : len(text),
+                       "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                                   edittime(revid))}
+                if query["rvprop"].count("content"):
+                    rev["*"] = text
+                result[title] = {"title" : title, "revisions" : [rev]}
+            pages_lock.release()
+
+            if query["titles"] == "Slow":
+                time.sleep(1)
+            self.answer(200, json.dumps({"query" : {"pages" : result}}))
+
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers["Content-Length"]))
+            form = dict(urlparse.parse_qsl(data))
+            title = dict(urlparse.parse_qsl(urlparse.urlparse(self.path)[4]))
+            pages_lock.acquire()
+            page = pages[title["title"]]
+            if form.get("wpEdittime") != \
+               time.strftime("%Y%m%d%H%M%S", edittime(page[1])):
+                # Not made from the current revision: edit conflict
+                pages_lock.release()
+                return self.answer(200, '<textarea name="wpTextbox2">')
+            page[0] = form["wpTextbox1"]
+            page[1] += 1
+            pages_lock.release()
+            self.answer(302, "", {"Location" : "/index.php"})
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), MockWiki)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+    config = {"host" : "127.0.0.1", "port" : server.server_address[1],
+              "basename" : "/index.php", "fetch_backend" : "api"}
+    site = Site(config, cache_time=0)
+    errors = []
+    conflicts = []
+
+    def get_art(title):
+        site.articles.lock.acquire()
+        try:
+            art = site.articles.peek(title)
+            if art is None:
+                art = Article(title, cache_time=0, **config)
+                site.articles.set(title, art)
+            return art
+        finally:
+            site.articles.lock.release()
+
+    def reader():
+        for i in range(200):
+            title = "Page%d" % random.randint(0, 19)
+            txt = site.get_article(title, get_art(title))
+            if not txt.startswith(title + " "):
+                errors.append("%s: %s" % (title, txt))
+
+    def writer(n):
+        for i in range(50):
+            title = "Page%d" % random.randint(0, 19)
+            art = get_art(title)
+            if art.set("%s %d-%d" % (title, n, i)):
+                continue
+            elif art.error == EDIT_CONFLICT:
+                # Saved meanwhile by another writer
+                conflicts.append(title)
+            else:
+                errors.append("%s: could not save" % title)
+
+    try:
+        from metadir import MetaDir
+    except ImportError:
+        print "fuse is not installed: MetaDir is not tested"
+        MetaDir = None
+
+    class SiteDir:
+        # The articles of the site as Page<n>.mw files
+        def title(self, path):
+            return os.path.basename(path)[:-3]
+
+        def contents(self, path):
+            return [title + ".mw" for title in pages.keys()]
+
+        def is_directory(self, path):
+            return path == "/"
+
+        def is_file(self, path):
+            return pages.has_key(self.title(path))
+
+        def size(self, path):
+            return len(self.read_file(path))
+
+        def mode(self, path):
+            return 0644
+
+        def mtime(self, path):
+            return 0
+
+        def read_file(self, path):
+            title = self.title(path)
+            return site.get_article(title, get_art(title))
+
+        def write_to(self, path, txt):
+            art = get_art(self.title(path))
+            if art.set(txt):
+                return True
+            elif art.error == EDIT_CONFLICT:
+                conflicts.append(path)
+                return -errno.EBUSY
+            return False
+
+        def revision(self, path):
+            art = site.articles.peek(self.title(path))
+            if art is not None:
+                return art.revid
+            return None
+
+        def pin(self, path):
+            site.articles.pin(self.title(path))
+
+        def unpin(self, path):
+            site.articles.unpin(self.title(path))
+
+    class TestFS(MetaDir or object):
+        def __init__(self):
+            MetaDir.__init__(self)
+            self.set_root(SiteDir())
+
+    def fs_reader():
+        for i in range(100):
+            path = "/Page%d.mw" % random.randint(0, 19)
+            fh = fs.open(path, os.O_RDONLY)
+            txt = fs.read(path, 4096, 0, fh)
+            fs.release(path, os.O_RDONLY, fh)
+            if not txt.startswith(path[1:-3] + " "):
+                errors.append("%s: %s" % (path, txt))
+
+    def fs_writer(n):
+        for i in range(20):
+            path = "/Page%d.mw" % random.randint(0, 19)
+            fh = fs.open(path, os.O_WRONLY | os.O_TRUNC)
+            fs.write(path, "%s fs %d-%d" % (path[1:-3], n, i), 0, fh)
+            error = fs.flush(path, fh)
+            fs.release(path, os.O_WRONLY, fh)
+            if error is not None and error != -errno.EBUSY:
+                errors.append("%s: flush returned %s" % (path, error))
+
+    def fs_editor(n):
+        # Saves as vi does: writes a swap file and renames it
+        for i in range(20):
+            path = "/Page%d.mw" % random.randint(0, 19)
+            swap = "/.%s.%d.swp" % (path[1:], n)
+            fh = fs.open(swap, os.O_WRONLY | os.O_TRUNC)
+            fs.write(swap, "%s editor %d-%d" % (path[1:-3], n, i), 0, fh)
+            fs.release(swap, os.O_WRONLY, fh)
+            error = fs.rename(swap, path)
+            if error is not None and error != -errno.EBUSY:
+                errors.append("%s: rename returned %s" % (path, error))
+
+    def fs_stat():
+        for i in range(500):
+            n = random.randint(0, 1)
+            swap = "/.Page%d.mw.%d.swp" % (random.randint(0, 19), n)
+            for path in (swap, "/Page%d.mw" % random.randint(0, 19)):
+                st = fs.getattr(path)
+                if st == -errno.ENOENT and path == swap:
+                    continue
+                if type(st) == int:
+                    errors.append("getattr %s returned %s" % (path, st))
+
+    start = time.time()
+    threads = [threading.Thread(target=reader) for i in range(8)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(2)]
+    if MetaDir is not None:
+        fs = TestFS()
+        threads += [threading.Thread(target=fs_reader) for i in range(4)]
+        threads += [threading.Thread(target=fs_writer, args=(i,))
+                    for i in range(2)]
+        threads += [threading.Thread(target=fs_editor, args=(i,))
+                    for i in range(2)]
+        threads.append(threading.Thread(target=fs_stat))
+    for t in threads:
+        t.start()
+
+    # Cached articles must be readable while another one is downloaded
+    cached = get_art("Page0")
+    cached.cache_time = 3600
+    site.get_article("Page0", cached)
+    slow = threading.Thread(target=site.get_article,
+                            args=("Slow", get_art("Slow")))
+    slow.start()
+    time.sleep(0.2)
+    t = time.time()
+    site.get_article("Page0", cached)
+    if time.time() - t > 0.5:
+        errors.append("cached read blocked by a slow download")
+    slow.join()
+
+    for t in threads:
+        t.join()
+
+    if MetaDir is not None:
+        # Edits replayed from the journal after a remount are saved by a
+        # site which never got their articles
+        import tempfile, shutil
+        from fs import ArticleDir
+        from writeback import Journal, WriteBackQueue
+        directory = tempfile.mkdtemp()
+        journal = Journal(os.path.join(directory, "journal"))
+        replayed = {}
+        for i in range(5):
+            title = "Page%d" % i
+            revid = pages[title][1]
+            if i % 2:
+                # Journaled without the revision
+                revid = None
+            replayed["/mock/%s.mw" % title] = "%s replayed" % title
+            journal.put({"path" : "/mock/%s.mw" % title,
+                         "content" : replayed["/mock/%s.mw" % title],
+                         "revid" : revid, "queued" : time.time(),
+                         "modified" : time.time()})
+        adir = ArticleDir(None, config, Site(config, cache_time=0))
+        queue = WriteBackQueue(journal, adir.upload)
+        queue.start()
+        deadline = time.time() + 10
+        while len(queue.paths()) > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        queue.stop()
+        for path in queue.paths():
+            errors.append("%s: replayed edit not uploaded" % path)
+        for path, txt in replayed.items():
+            if pages[adir.get_title(path)][0] != txt:
+                errors.append("%s: replayed edit lost" % path)
+        shutil.rmtree(directory)
+
+    print "%d threads, %.2f s, %d errors" % (len(threads) + 1,
+                                             time.time() - start, len(errors))
+    for error in errors[:10]:
+        print error
+    print STATS.dump()
+
+    # Lets the server threads end before the interpreter
+    POOL.clear()
+    server.shutdown()
+    time.sleep(0.1)
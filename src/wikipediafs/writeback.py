@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+
+# WikipediaFS
+# Copyright (C) 2005 - 2007 Mathieu Blondel
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, time, threading, tempfile
+from collections import OrderedDict
+from stats import STATS
+from logger import LOGGER
+from hashlib import sha1
+
+# Returned by upload functions when the article was changed on the server
+# since the edit was made
+CONFLICT = "conflict"
+# Returned by upload functions when the user may not save the article
+REJECTED = "rejected"
+
+class Journal:
+    """
+    Edits waiting to be uploaded, kept on disk so that they survive a crash
+    or an unmount.
+    There is one file per file system path, named after its SHA-1, so that
+    a newer edit of an article replaces the previous one. Files are written
+    atomically (temporary file + rename) and synced before put returns.
+    """
+
+    MAGIC = "WFS-JOURNAL-1"
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, 0700)
+
+    def __file_name(self, path):
+        return os.path.join(self.directory, sha1(path).hexdigest())
+
+    def load(self):
+        """
+        Returns the journaled edits, oldest first, as a list of dictionaries
+        with the path, content, queued and modified (times) of the edits and
+        the revision (revid) they were made from.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            file_name = os.path.join(self.directory, name)
+            if name.startswith("."):
+                # temporary file left by a crash
+                os.remove(file_name)
+                continue
+
+            try:
+                f = open(file_name, "rb")
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                # The revid line is empty when the revision is unknown:
+                # the header is six lines followed by an empty one
+                magic, path, revid, queued, modified, length, content = \
+                    data.split("\n", 6)
+                if magic != self.MAGIC or not content.startswith("\n"):
+                    raise ValueError
+                content = content[1:]
+                if int(length) != len(content):
+                    raise ValueError
+            except (IOError, OSError, ValueError):
+                # Unreadable or truncated entry
+                LOGGER.error("Invalid journal entry %s" % file_name)
+                continue
+
+            entries.append({
+                "path" : path,
+                "content" : content,
+                "revid" : revid and int(revid) or None,
+                "queued" : float(queued),
+                "modified" : float(modified)
+            })
+
+        entries.sort(lambda a, b: cmp(a["queued"], b["queued"]))
+        return entries
+
+    def put(self, entry):
+        revid = ""
+        if entry["revid"] is not None:
+            revid = str(entry["revid"])
+        header = "\n".join((self.MAGIC, entry["path"], revid,
+                            repr(entry["queued"]), repr(entry["modified"]),
+                            str(len(entry["content"]))))
+
+        fd, tmp = tempfile.mkstemp(prefix=".", dir=self.directory)
+        try:
+            os.write(fd, header + "\n\n" + entry["content"])
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.__file_name(entry["path"]))
+
+    def remove(self, path):
+        try:
+            os.remove(self.__file_name(path))
+        except OSError:
+            pass
+
+class WriteBackQueue:
+    """
+    Uploads saved files in the background.
+    put journals the new content of a file and returns at once. A daemon
+    thread calls upload(path, content, revid, force) for each journaled file,
+    oldest first, and retries failed uploads with an exponential backoff
+    (from retry_delay up to max_delay seconds). Edits found in the journal
+    are queued again on start.
+    upload returns True, False, CONFLICT or REJECTED; conflicting and
+    rejected edits are kept until they are published with force (then
+    force is True) or dropped.
+    When hold is set (offline mode), nothing is uploaded until publish is
+    called.
+    queued(path) and done(path) are called when a path enters and leaves
+    the queue. The result of each upload is appended to log_file.
+    """
+
+    # Number of results shown by status
+    RESULTS = 50
+
+    def __init__(self, journal, upload, queued=None, done=None,
+                 retry_delay=5, max_delay=300, hold=False, log_file=None):
+        self.journal = journal
+        self.upload = upload
+        self.queued = queued
+        self.done = done
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.hold = hold
+        self.log_file = log_file
+        self.cond = threading.Condition(threading.RLock())
+        # path -> entry, in the order they were queued
+        self.entries = OrderedDict()
+        # path -> (time, result) of the last uploads
+        self.results = OrderedDict()
+        # Number of uploads being published
+        self.publishing = 0
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        for entry in self.journal.load():
+            LOGGER.info("Replaying journaled edit of %s" % entry["path"])
+            self.__add(entry)
+            STATS.incr("writeback", "replayed")
+
+        self.running = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.running = False
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def __add(self, entry):
+        # Must be called with the lock held (or before start)
+        new = not self.entries.has_key(entry["path"])
+        entry["version"] = 0
+        if not new:
+            old = self.entries[entry["path"]]
+            entry["version"] = old["version"] + 1
+            entry["uploading"] = old["uploading"]
+        else:
+            entry["uploading"] = False
+        # CONFLICT or REJECTED when it must not be uploaded again
+        entry["held"] = None
+        entry["attempts"] = 0
+        entry["next_try"] = 0
+        # Set by publish with force
+        entry["force"] = False
+        self.entries[entry["path"]] = entry
+        STATS.set("writeback", "queue_depth", len(self.entries))
+
+        if new and self.queued is not None:
+            self.queued(entry["path"])
+
+    def put(self, path, content, revid=None):
+        """
+        Queues content to be uploaded to path, replacing the edit of path
+        which may still be waiting. revid is the revision the edit was made
+        from, if known.
+        Raises IOError or OSError if the edit could not be journaled.
+        """
+        self.cond.acquire()
+        try:
+            now = time.time()
+            queued = now
+            if self.entries.has_key(path):
+                # Waiting since the first edit that was not uploaded,
+                # and made from the same revision
+                queued = self.entries[path]["queued"]
+                revid = self.entries[path]["revid"]
+
+            entry = {
+                "path" : path,
+                "content" : content,
+                "revid" : revid,
+                "queued" : queued,
+                "modified" : now
+            }
+            self.journal.put(entry)
+            self.__add(entry)
+            STATS.incr("writeback", "queued")
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def drop(self, path):
+        """
+        Forgets the edit waiting to be uploaded to path.
+        """
+        self.cond.acquire()
+        try:
+            entry = self.entries.get(path)
+            if entry is None or entry["uploading"]:
+                return False
+            self.entries.pop(path)
+            self.journal.remove(path)
+            STATS.set("writeback", "queue_depth", len(self.entries))
+            self.__record(path, "dropped")
+        finally:
+            self.cond.release()
+
+        if self.done is not None:
+            self.done(path)
+        return True
+
+    def publish(self, paths=None, force=False, threads=4):
+        """
+        Uploads the waiting edits of paths (all of them by default) with
+        at most threads uploads at a time, in the background.
+        With force, conflicting edits are uploaded anyway.
+        """
+        self.cond.acquire()
+        try:
+            entries = []
+            for entry in self.entries.values():
+                if entry["uploading"]:
+                    continue
+                if paths is not None and paths.count(entry["path"]) == 0:
+                    continue
+                if entry["held"] and not force:
+                    continue
+                if force:
+                    entry["revid"] = None
+                    entry["force"] = True
+                entry["uploading"] = True
+                entries.append(entry)
+            self.publishing += len(entries)
+        finally:
+            self.cond.release()
+
+        for i in range(min(threads, len(entries))):
+            thread = threading.Thread(target=self.__publish,
+                                      args=(entries,))
+            thread.setDaemon(True)
+            thread.start()
+        return len(entries)
+
+    def __publish(self, entries):
+        while True:
+            self.cond.acquire()
+            try:
+                if len(entries) == 0:
+                    return
+                entry = entries.pop(0)
+            finally:
+                self.cond.release()
+
+            self.__upload(entry)
+            self.cond.acquire()
+            try:
+                self.publishing -= 1
+            finally:
+                self.cond.release()
+
+    def pending(self, path):
+        """
+        Returns the entry (content, revid, queued, modified, attempts,
+        held) waiting to be uploaded to path, or None.
+        """
+        self.cond.acquire()
+        try:
+            entry = self.entries.get(path)
+            if entry is not None:
+                return dict(entry)
+            return None
+        finally:
+            self.cond.release()
+
+    def paths(self):
+        self.cond.acquire()
+        try:
+            return self.entries.keys()
+        finally:
+            self.cond.release()
+
+    def status(self):
+        """
+        Returns the queue depth, the age of the oldest edit, the list of
+        the waiting edits and the last results as text.
+        """
+        self.cond.acquire()
+        try:
+            now = time.time()
+            entries = [dict(e) for e in self.entries.values()]
+            results = self.results.items()
+            publishing = self.publishing
+        finally:
+            self.cond.release()
+
+        oldest = 0
+        if len(entries) > 0:
+            oldest = int(now - min([e["queued"] for e in entries]))
+
+        lines = ["queue_depth %d" % len(entries),
+                 "oldest_age %d" % oldest,
+                 "offline %d" % int(self.hold),
+                 "publishing %d" % publishing,
+                 ""]
+        for e in entries:
+            if e["uploading"]:
+                state = "uploading"
+            elif e["held"]:
+                state = e["held"]
+            else:
+                state = "waiting"
+            line = "%s %s age=%d size=%d attempts=%d" % \
+                   (e["path"], state, int(now - e["queued"]),
+                    len(e["content"]), e["attempts"])
+            if e["next_try"] > now and not self.hold:
+                line += " retry_in=%d" % int(e["next_try"] - now)
+            lines.append(line)
+
+        if len(results) > 0:
+            lines.append("")
+            for path, (result_time, result) in results:
+                lines.append("%s %s %s" % (
+                    time.strftime("%Y-%m-%d %H:%M:%S",
+                                  time.localtime(result_time)),
+                    path, result))
+        lines.append("")
+        return "\n".join(lines)
+
+    def __next(self):
+        # Must be called with the lock held
+        # Returns the next entry to upload or the time to wait for one
+        wait = None
+        now = time.time()
+        if self.hold:
+            return None, None
+        for entry in self.entries.values():
+            if entry["uploading"] or entry["held"]:
+                continue
+            if entry["next_try"] <= now:
+                return entry, None
+            if wait is None or entry["next_try"] - now < wait:
+                wait = entry["next_try"] - now
+        return None, wait
+
+    def __run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while self.running:
+                    entry, wait = self.__next()
+                    if entry is not None:
+                        break
+                    self.cond.wait(wait)
+                if not self.running:
+                    return
+                entry["uploading"] = True
+            finally:
+                self.cond.release()
+
+            self.__upload(entry)
+
+    def __upload(self, entry):
+        # entry must have been marked as uploading
+        try:
+            result = self.upload(entry["path"], entry["content"],
+                                 entry["revid"], entry["force"])
+        except Exception, e:
+            LOGGER.error("Upload of %s failed: %s" % (entry["path"], e))
+            result = False
+
+        self.__uploaded(entry, result)
+
+    def __record(self, path, result):
+        # Must be called with the lock held
+        now = time.time()
+        if self.results.has_key(path):
+            self.results.pop(path)
+        self.results[path] = (now, result)
+        while len(self.results) > self.RESULTS:
+            self.results.popitem(False)
+
+        if self.log_file is not None:
+            try:
+                f = open(self.log_file, "a")
+                try:
+                    f.write("%s %s %s\n" % (
+                        time.strftime("%Y-%m-%d %H:%M:%S",
+                                      time.localtime(now)),
+                        path, result))
+                finally:
+                    f.close()
+            except IOError, e:
+                LOGGER.error("Cannot write %s: %s" % (self.log_file, e))
+
+    def __uploaded(self, entry, result):
+        path = entry["path"]
+        self.cond.acquire()
+        try:
+            current = self.entries[path]
+            current["uploading"] = False
+            self.cond.notify()
+            if result == CONFLICT or result == REJECTED:
+                STATS.incr("writeback", "%s_uploads" % result)
+                LOGGER.info("Upload of %s %s" % (path, result))
+                current["held"] = result
+                self.__record(path, result)
+                return
+
+            if not result:
+                STATS.incr("writeback", "failures")
+                self.__record(path, "failed")
+                current["attempts"] += 1
+                delay = self.retry_delay * 2 ** (current["attempts"] - 1)
+                current["next_try"] = time.time() + min(delay, self.max_delay)
+                LOGGER.info("Upload of %s failed, retrying in %d seconds" %
+                            (path, current["next_try"] - time.time()))
+                return
+
+            STATS.incr("writeback", "uploaded")
+            self.__record(path, "published")
+            if current["version"] != entry["version"]:
+                # Edited again while it was uploaded: the new edit is made
+                # from the revision which has just been uploaded
+                current["revid"] = None
+                return
+
+            self.entries.pop(path)
+            self.journal.remove(path)
+            STATS.set("writeback", "queue_depth", len(self.entries))
+        finally:
+            self.cond.release()
+
+        if self.done is not None:
+            self.done(path)